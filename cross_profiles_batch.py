@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ -------------------
+        Name                 : cross_profiles_batch
+        Begin                : 22/01/2024
+        Copyright            : (C) 2024 by k_hor
+        Email                : horvathova190@uniba.sk
+        Description:         : Runs the Cross Profiles tool for many pairs of LAS folder and river line in one invocation.\
+                               Jobs are run in parallel, each into its own subfolder, and DTM tiles are shared
+                               between jobs with overlapping survey blocks.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (QgsApplication,
+                       QgsProcessing,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingContext,
+                       QgsProcessingFeedback,
+                       QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterField,
+                       QgsProcessingParameterString,
+                       QgsProcessingParameterFile,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingException,
+                       QgsProcessingMultiStepFeedback,
+                       )
+from qgis import processing
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import csv
+import glob
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+#helper modules are placed next to this script
+_script_folder = os.path.dirname(os.path.abspath(__file__))
+if _script_folder not in sys.path:
+    sys.path.append(_script_folder)
+#module import keeps CrossProfilesAlgorithm out of this script, QGIS loads the first algorithm class it finds
+import cross_profiles_update
+
+
+def read_jobs_file(path):
+    """Reads jobs from a CSV file with columns name, las_folder and line, relative paths are relative to the file."""
+    folder = os.path.dirname(os.path.abspath(path))
+    with open(path, newline='', encoding='utf-8') as f:
+        dialect = csv.Sniffer().sniff(f.read(2048), delimiters=',;\t')
+        f.seek(0)
+        jobs = []
+        for number, row in enumerate(csv.DictReader(f, dialect=dialect), 1):
+            jobs.append({'name': row.get('name') or f'job_{number}',
+                         'las_folder': os.path.join(folder, row['las_folder']),
+                         'line': os.path.join(folder, row['line'])})
+    return jobs
+
+
+def qgis_process_executable():
+    """Path to qgis_process, used to run jobs in separate processes."""
+    for name in ('qgis_process', 'qgis_process-qgis.bat', 'qgis_process-qgis-ltr.bat'):
+        path = shutil.which(name)
+        if path:
+            return path
+        path = os.path.join(QgsApplication.prefixPath(), 'bin', name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+class CrossProfilesBatchAlgorithm(QgsProcessingAlgorithm):
+
+    JOBS_FILE = 'JOBS_FILE'
+    JOBS_LAYER = 'JOBS_LAYER'
+    LAS_FOLDER_FIELD = 'LAS_FOLDER_FIELD'
+    NAME_FIELD = 'NAME_FIELD'
+    OUTPUT_FOLDER = 'OUTPUT_FOLDER'
+    Width = 'Width'
+    Spacing = 'Spacing'
+    CLASSES = 'CLASSES'
+    PARALLEL_JOBS = 'PARALLEL_JOBS'
+    WORKERS = 'WORKERS'
+    SHARE_DTM_TILES = 'SHARE_DTM_TILES'
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterFile(
+            self.JOBS_FILE,
+            self.tr("Jobs CSV file (columns name, las_folder, line)"),
+            extension='csv',
+            optional=True))
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.JOBS_LAYER,
+                self.tr('Jobs line layer (one river line per feature)'),
+                [QgsProcessing.TypeVectorLine],
+                optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.LAS_FOLDER_FIELD,
+                self.tr('Field with LAS folder of the job'),
+                parentLayerParameterName=self.JOBS_LAYER,
+                type=QgsProcessingParameterField.String,
+                optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.NAME_FIELD,
+                self.tr('Field with name of the job'),
+                parentLayerParameterName=self.JOBS_LAYER,
+                optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.Width,
+                self.tr('Width')
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.Spacing,
+                self.tr('Spacing')
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.CLASSES,
+                self.tr('Classification values of terrain points (comma separated)'),
+                defaultValue='2, 9'
+            )
+        )
+        self.addParameter(QgsProcessingParameterFile(
+            self.OUTPUT_FOLDER,
+            self.tr("Output Folder"),
+            behavior=QgsProcessingParameterFile.Folder))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PARALLEL_JOBS,
+                self.tr('Number of jobs run in parallel (1 = one after another in this process)'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=1,
+                minValue=1
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                self.tr('Number of worker processes of each job (0 = all CPU cores)'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=0,
+                minValue=0
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.SHARE_DTM_TILES,
+                self.tr('Share DTM tiles between jobs (tiled DTM)'),
+                defaultValue=True
+            )
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        output_folder = self.parameterAsString(parameters, self.OUTPUT_FOLDER, context)
+        Width = int(self.parameterAsString(parameters, self.Width, context))
+        Spacing = int(self.parameterAsString(parameters, self.Spacing, context))
+        classes = self.parameterAsString(parameters, self.CLASSES, context)
+        parallel_jobs = self.parameterAsInt(parameters, self.PARALLEL_JOBS, context)
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
+        share_tiles = self.parameterAsBoolean(parameters, self.SHARE_DTM_TILES, context)
+
+        jobs = []
+        jobs_file = self.parameterAsString(parameters, self.JOBS_FILE, context)
+        if jobs_file:
+            jobs.extend(read_jobs_file(jobs_file))
+
+        jobs_layer = self.parameterAsVectorLayer(parameters, self.JOBS_LAYER, context)
+        if jobs_layer is not None:
+            las_folder_field = self.parameterAsString(parameters, self.LAS_FOLDER_FIELD, context)
+            name_field = self.parameterAsString(parameters, self.NAME_FIELD, context)
+            if not las_folder_field:
+                raise QgsProcessingException("Field with LAS folder is required for jobs line layer.")
+            for feature in jobs_layer.getFeatures():
+                name = str(feature[name_field]) if name_field else f'line_{feature.id()}'
+                jobs.append({'name': name, 'las_folder': feature[las_folder_field],
+                             'line': (jobs_layer, feature.id())})
+
+        if not jobs:
+            raise QgsProcessingException("No jobs given, set jobs CSV file or jobs line layer.")
+
+        #every job has its own subfolder
+        used_names = set()
+        for job in jobs:
+            folder_name = re.sub(r'[^\w\-]+', '_', job['name']).strip('_') or 'job'
+            while folder_name in used_names:
+                folder_name += '_'
+            used_names.add(folder_name)
+            job['folder'] = os.path.join(output_folder, folder_name)
+            os.makedirs(job['folder'], exist_ok=True)
+            if isinstance(job['line'], tuple):
+                layer, fid = job['line']
+                job['line'] = os.path.join(job['folder'], 'line.gpkg')
+                processing.run("native:extractbyexpression",
+                               {'INPUT': layer,
+                                'EXPRESSION': f'$id = {fid}',
+                                'OUTPUT': job['line']}, context=context, feedback=feedback)
+
+        #DTM tiles of overlapping survey blocks are computed once
+        tile_cache = os.path.join(output_folder, 'dtm_tiles') if share_tiles else ''
+
+        def job_parameters(job):
+            return {
+                cross_profiles_update.CrossProfilesAlgorithm.INPUT_LAS_FOLDER: job['las_folder'],
+                cross_profiles_update.CrossProfilesAlgorithm.LINE_INPUT: job['line'],
+                cross_profiles_update.CrossProfilesAlgorithm.OUTPUT_FOLDER: job['folder'],
+                cross_profiles_update.CrossProfilesAlgorithm.Width: str(Width),
+                cross_profiles_update.CrossProfilesAlgorithm.Spacing: str(Spacing),
+                cross_profiles_update.CrossProfilesAlgorithm.CLASSES: classes,
+                cross_profiles_update.CrossProfilesAlgorithm.WORKERS: workers,
+                cross_profiles_update.CrossProfilesAlgorithm.DTM_METHOD: 1 if share_tiles else 0,
+                cross_profiles_update.CrossProfilesAlgorithm.DTM_TILE_CACHE: tile_cache,
+                cross_profiles_update.CrossProfilesAlgorithm.ADD_TO_PROJECT: False,
+            }
+
+        #one step of the progress bar for every job run in this process
+        job_feedback = QgsProcessingMultiStepFeedback(len(jobs), feedback)
+
+        def run_in_process(job):
+            processing.run(cross_profiles_update.CrossProfilesAlgorithm().create(), job_parameters(job),
+                           context=context, feedback=job_feedback)
+
+        executable = qgis_process_executable() if parallel_jobs > 1 else None
+        if parallel_jobs > 1 and executable is None:
+            feedback.pushInfo("qgis_process was not found, jobs are run one after another.")
+            parallel_jobs = 1
+
+        def run_in_subprocess(job):
+            command = [executable, 'run', os.path.join(_script_folder, 'cross_profiles_update.py'), '--']
+            command += [f'{key}={value}' for key, value in job_parameters(job).items()]
+            with open(os.path.join(job['folder'], 'log.txt'), 'w') as log:
+                process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+                #running jobs are stopped when the batch is canceled
+                while True:
+                    try:
+                        returncode = process.wait(timeout=1)
+                        break
+                    except subprocess.TimeoutExpired:
+                        if feedback.isCanceled():
+                            process.terminate()
+                            process.wait()
+                            raise RuntimeError("canceled")
+            if returncode != 0:
+                raise RuntimeError(f"qgis_process exited with code {returncode}, see log.txt")
+
+        def run_job(job):
+            start_time = time.time()
+            if feedback.isCanceled():
+                job.update(status='canceled', error='', seconds=0, profiles=0)
+                return job
+            try:
+                if parallel_jobs > 1:
+                    run_in_subprocess(job)
+                else:
+                    run_in_process(job)
+                job['status'] = 'ok'
+                job['error'] = ''
+            except Exception as e:
+                job['status'] = 'canceled' if feedback.isCanceled() else 'failed'
+                job['error'] = str(e)
+            job['seconds'] = round(time.time() - start_time, 1)
+            job['profiles'] = len(glob.glob(os.path.join(job['folder'], 'profile_*.png')))
+            return job
+
+        feedback.pushInfo(f"Running {len(jobs)} jobs, {parallel_jobs} in parallel...")
+        if parallel_jobs > 1:
+            with ThreadPoolExecutor(max_workers=parallel_jobs) as pool:
+                for done, job in enumerate(pool.map(run_job, jobs), 1):
+                    feedback.pushInfo(f"Job {job['name']}: {job['status']} in {job['seconds']} s {job['error']}")
+                    feedback.setProgress(100 * done / len(jobs))
+        else:
+            for number, job in enumerate(jobs):
+                job_feedback.setCurrentStep(number)
+                run_job(job)
+                feedback.pushInfo(f"Job {job['name']}: {job['status']} in {job['seconds']} s {job['error']}")
+
+        summary = os.path.join(output_folder, 'batch_summary.csv')
+        with open(summary, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=['name', 'las_folder', 'line', 'folder', 'status',
+                                                   'seconds', 'profiles', 'error'])
+            writer.writeheader()
+            writer.writerows(jobs)
+        feedback.pushInfo(f"Summary saved to {summary}")
+
+        failed = [job['name'] for job in jobs if job['status'] == 'failed']
+        if failed:
+            feedback.reportError(f"Failed jobs: {', '.join(failed)}")
+
+        return {}
+
+    def name(self):
+        return 'cross_profiles_batch'
+
+    def tr(self, string):
+        return QCoreApplication.translate('cross_profiles_batch', string)
+
+    def displayName(self):
+        return self.tr('Cross Profiles (batch)')
+
+    def group(self):
+        return self.tr('')
+
+    def groupId(self):
+        return ''
+
+    def shortHelpString(self):
+        """
+        Returns a localised short helper string for the algorithm. This string
+        should provide a basic description about what the algorithm does and the
+        parameters and outputs associated with it..
+        """
+        return self.tr("Runs Cross profiles for many pairs of LAS folder and river line.\
+        Jobs are read from a CSV file with columns name, las_folder and line (path to line layer),\
+        or from a line layer where every feature is one river and a field holds its LAS folder.\n\
+        Every job writes its outputs to its own subfolder of the output folder and batch_summary.csv\
+        lists the result of every job. With more than one parallel job, jobs run in separate qgis_process processes.\n\
+        With shared DTM tiles, the tiled DTM method is used and tiles of survey blocks shared by several jobs are created only once.\n")
+
+    def createInstance(self):
+        return CrossProfilesBatchAlgorithm()
+
+
+class ConsoleFeedback(QgsProcessingFeedback):
+
+    def pushInfo(self, info):
+        print(info)
+
+    def reportError(self, error, fatalError=False):
+        print(error, file=sys.stderr)
+
+
+def main(argv=None):
+    """Runs the batch without QGIS GUI, from standalone Python with PyQGIS."""
+    parser = argparse.ArgumentParser(description='Cross profiles for many LAS folders and river lines.')
+    parser.add_argument('jobs', help='CSV file with columns name, las_folder, line')
+    parser.add_argument('output', help='output folder')
+    parser.add_argument('--width', required=True)
+    parser.add_argument('--spacing', required=True)
+    parser.add_argument('--classes', default='2, 9', help='classification values of terrain points, e.g. "2, 9"')
+    parser.add_argument('--parallel', type=int, default=1, help='number of jobs run in parallel')
+    parser.add_argument('--workers', type=int, default=0, help='worker processes of each job, 0 = all CPU cores')
+    parser.add_argument('--no-shared-tiles', action='store_true', help='do not share DTM tiles between jobs')
+    args = parser.parse_args(argv)
+
+    application = QgsApplication([], False)
+    application.initQgis()
+    from processing.core.Processing import Processing
+    from qgis.analysis import QgsNativeAlgorithms
+    Processing.initialize()
+    QgsApplication.processingRegistry().addProvider(QgsNativeAlgorithms())
+
+    algorithm = CrossProfilesBatchAlgorithm().create()
+    context = QgsProcessingContext()
+    feedback = ConsoleFeedback()
+    results, ok = algorithm.run({
+        CrossProfilesBatchAlgorithm.JOBS_FILE: args.jobs,
+        CrossProfilesBatchAlgorithm.OUTPUT_FOLDER: args.output,
+        CrossProfilesBatchAlgorithm.Width: args.width,
+        CrossProfilesBatchAlgorithm.Spacing: args.spacing,
+        CrossProfilesBatchAlgorithm.CLASSES: args.classes,
+        CrossProfilesBatchAlgorithm.PARALLEL_JOBS: args.parallel,
+        CrossProfilesBatchAlgorithm.WORKERS: args.workers,
+        CrossProfilesBatchAlgorithm.SHARE_DTM_TILES: not args.no_shared_tiles,
+    }, context, feedback)
+    application.exitQgis()
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ -------------------
+        Name                 : cross_profiles_benchmark
+        Begin                : 22/01/2024
+        Copyright            : (C) 2024 by k_hor
+        Email                : horvathova190@uniba.sk
+        Description:         : Benchmark of the profile pipeline on synthetic LAS tiles and river lines.\
+                               Runs without QGIS and without network, results of every run are appended
+                               to benchmark_results.csv, so runs of two versions can be compared:
+                               python cross_profiles_benchmark.py OUTPUT_FOLDER --points 1000000 4000000 --workers 1 8
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import argparse
+import csv
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+#helper module cross_profiles_core.py is placed next to this script
+_script_folder = os.path.dirname(os.path.abspath(__file__))
+if _script_folder not in sys.path:
+    sys.path.append(_script_folder)
+from cross_profiles_core import (read_las_header, read_line_parts, create_transects, build_dtm_tiled,
+                                 sample_profiles_from_dtm, sample_profiles_from_points, render_profiles, write_profile_store,
+                                 PARQUET_AVAILABLE, RunReport)
+
+#fixtures lie in UTM zone 34N (EPSG:32634), which covers Slovakia
+FIXTURE_EPSG = 32634
+FIXTURE_ORIGIN = (400000.0, 5350000.0)
+#share of points of every class outside the river channel, points in the channel are ground (2) or water (9)
+CLASS_MIX = {2: 0.6, 3: 0.1, 5: 0.2, 6: 0.1}
+#valleys of the fixtures: amplitude and wavelength of the meanders and width of the river channel [m]
+TERRAINS = {'meander': {'amplitude': 60.0, 'wavelength': 800.0, 'channel_width': 20.0},
+            'straight': {'amplitude': 0.0, 'wavelength': 800.0, 'channel_width': 20.0},
+            'tight': {'amplitude': 150.0, 'wavelength': 400.0, 'channel_width': 20.0},
+            'wide': {'amplitude': 60.0, 'wavelength': 800.0, 'channel_width': 80.0}}
+RESULT_FIELDS = ['label', 'date', 'python', 'cpu_count', 'case', 'points', 'length', 'width', 'spacing', 'workers',
+                 'terrain', 'class_mix', 'repeat', 'stage', 'wall', 'cpu', 'stage_peak_rss', 'lifetime_max_rss',
+                 'lifetime_max_rss_children', 'read_bytes', 'write_bytes', 'count']
+
+
+def parse_class_mix(text):
+    """Class mix from text like 2:0.6,3:0.1,5:0.2,6:0.1 (class:share, shares are normalized)."""
+    class_mix = {}
+    try:
+        for item in text.split(','):
+            value, share = item.split(':')
+            class_mix[int(value)] = float(share)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"class mix {text} is not like 2:0.6,3:0.1,5:0.2,6:0.1")
+    if not class_mix or any(not 0 <= c <= 255 or share < 0 for c, share in class_mix.items()) \
+            or sum(class_mix.values()) <= 0:
+        raise argparse.ArgumentTypeError(f"class mix {text} needs classes 0-255 and positive shares")
+    return class_mix
+
+
+def format_class_mix(class_mix):
+    return ','.join(f'{c}:{share:g}' for c, share in class_mix.items())
+
+
+def river_centerline(length, amplitude=60.0, wavelength=800.0, step=5.0):
+    """Meandering river line along the x axis, local coordinates (x, y) every step metres."""
+    x = np.arange(0.0, length + step / 2, step)
+    return np.column_stack([x, amplitude * np.sin(2 * np.pi * x / wavelength)])
+
+
+def synthetic_terrain(x, y, amplitude=60.0, wavelength=800.0, channel_width=20.0):
+    """
+    Valley terrain in local coordinates: river channel 3 m deep around the meandering center line,
+    floodplain rising to both sides with low waves, whole valley falling 1 m per km downstream.
+    Returns (elevation, in_channel).
+    """
+    across = y - amplitude * np.sin(2 * np.pi * x / wavelength)
+    half = channel_width / 2
+    in_channel = np.abs(across) < half
+    z = 200.0 - 0.001 * x + 0.01 * np.abs(across) + 0.3 * np.sin(x / 37.0) * np.cos(y / 23.0)
+    z = np.where(in_channel, z - 3.0 * (1 - (across / half) ** 2), z)
+    return z, in_channel
+
+
+def write_synthetic_las(path, x, y, z, classification, epsg=FIXTURE_EPSG):
+    """Writes points to an uncompressed LAS 1.2 file (point format 1) with a GeoTIFF keys VLR of epsg."""
+    scale = 0.01
+    offset = (float(np.floor(x.min())), float(np.floor(y.min())), float(np.floor(z.min())))
+    points = np.zeros(len(x), dtype=np.dtype([('X', '<i4'), ('Y', '<i4'), ('Z', '<i4'), ('intensity', '<u2'),
+                                              ('returns', 'u1'), ('classification', 'u1'), ('scan_angle', 'i1'),
+                                              ('user_data', 'u1'), ('point_source', '<u2'), ('gps_time', '<f8')]))
+    points['X'] = np.round((x - offset[0]) / scale)
+    points['Y'] = np.round((y - offset[1]) / scale)
+    points['Z'] = np.round((z - offset[2]) / scale)
+    #first of one return
+    points['returns'] = 0b001001
+    points['classification'] = classification
+    points['intensity'] = 100
+
+    #projected CRS (1024 = 1), raster pixel is area (1025 = 1), projected CRS code (3072)
+    geokeys = struct.pack('<16H', 1, 1, 0, 3, 1024, 0, 1, 1, 1025, 0, 1, 1, 3072, 0, 1, epsg)
+    vlr = struct.pack('<H16sHH32s', 0, b'LASF_Projection', 34735, len(geokeys), b'GeoKeyDirectoryTag') + geokeys
+    header_size = 227
+    today = time.localtime()
+    header = struct.pack('<4sHH16sBB32s32sHHHIIBHI5I3d3d6d',
+                         b'LASF', 0, 0, bytes(16), 1, 2, b'SYNTHETIC', b'cross_profiles_benchmark',
+                         today.tm_yday, today.tm_year, header_size, header_size + len(vlr), 1,
+                         1, points.itemsize, len(points), len(points), 0, 0, 0, 0,
+                         scale, scale, scale, *offset,
+                         float(x.max()), float(x.min()), float(y.max()), float(y.min()),
+                         float(z.max()), float(z.min()))
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(vlr)
+        f.write(points.tobytes())
+
+
+def write_river_line(path, vertices, epsg=FIXTURE_EPSG):
+    """Writes the river line to a shapefile."""
+    from osgeo import ogr, osr
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    if os.path.exists(path):
+        driver.DeleteDataSource(path)
+    dataset = driver.CreateDataSource(path)
+    layer = dataset.CreateLayer('river', srs, ogr.wkbLineString)
+    line = ogr.Geometry(ogr.wkbLineString)
+    for x, y in vertices:
+        line.AddPoint_2D(float(x), float(y))
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(line)
+    layer.CreateFeature(feature)
+    dataset = None
+
+
+def create_fixture(folder, points, length, half_width, seed=1, tile_size=500.0, class_mix=CLASS_MIX, terrain='meander'):
+    """
+    Generates LAS tiles of tile_size metres with points spread uniformly over the valley
+    (length x 2 * half_width around the river line) and the river line river.shp.
+    terrain is one of TERRAINS, class_mix the shares of classes outside the river channel.
+    A fixture with the same parameters in folder is reused. Returns (las_files, line_path).
+    """
+    valley = TERRAINS[terrain]
+    amplitude = valley['amplitude']
+    params = {'points': points, 'length': length, 'half_width': half_width, 'seed': seed,
+              'tile_size': tile_size, 'class_mix': {str(c): share for c, share in class_mix.items()},
+              'terrain': dict(valley, name=terrain)}
+    line_path = os.path.join(folder, 'river.shp')
+    params_path = os.path.join(folder, 'fixture.json')
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            if json.load(f) == params:
+                return sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith('.las')), line_path
+        shutil.rmtree(folder)
+    os.makedirs(folder, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    y_min, y_max = -amplitude - half_width, amplitude + half_width
+    classes = np.array(list(class_mix))
+    shares = np.array(list(class_mix.values()), dtype=float)
+    shares /= shares.sum()
+    las_files = []
+    tiles = int(np.ceil(length / tile_size))
+    for tile in range(tiles):
+        x0 = tile * tile_size
+        x1 = min(x0 + tile_size, length)
+        count = int(round(points * (x1 - x0) / length))
+        x = rng.uniform(x0, x1, count)
+        y = rng.uniform(y_min, y_max, count)
+        z, in_channel = synthetic_terrain(x, y, **valley)
+        classification = rng.choice(classes, count, p=shares).astype(np.uint8)
+        #water surface at 1 m below the floodplain edge, the bed is hit by a third of the points
+        water = in_channel & (rng.random(count) > 0.3)
+        classification[in_channel] = 2
+        classification[water] = 9
+        z = np.where(water, np.maximum(z, 200.0 - 0.001 * x - 1.0), z)
+        #vegetation and buildings stand above the ground
+        z = z + np.where(classification == 3, rng.uniform(0.2, 1.0, count), 0.0)
+        z = z + np.where(classification == 5, rng.uniform(3.0, 20.0, count), 0.0)
+        z = z + np.where(classification == 6, rng.uniform(4.0, 10.0, count), 0.0)
+        path = os.path.join(folder, f'tile_{tile:03d}.las')
+        write_synthetic_las(path, x + FIXTURE_ORIGIN[0], y + FIXTURE_ORIGIN[1], z, classification)
+        las_files.append(path)
+
+    write_river_line(line_path, river_centerline(length, amplitude, valley['wavelength']) + FIXTURE_ORIGIN)
+    with open(params_path, 'w') as f:
+        json.dump(params, f, indent=1)
+    return las_files, line_path
+
+
+def benchmark_case(las_files, line_path, folder, width, spacing, workers, engines=('dtm',), graphs=True,
+                   resolution=0.5, classes=(2, 9)):
+    """Runs the pipeline stages of one case into folder, returns RunReport with a record of every stage."""
+    os.makedirs(folder, exist_ok=True)
+    report = RunReport(folder)
+    with report.stage('transects') as record:
+        parts, crs_wkt = read_line_parts(line_path)
+        transects = create_transects(parts, width, spacing)
+        record['count'] = len(transects)
+    profiles = None
+    if 'dtm' in engines:
+        output_DTM = os.path.join(folder, 'DTM.tif')
+        with report.stage('dtm', count=sum(read_las_header(path).point_count for path in las_files)):
+            build_dtm_tiled(las_files, output_DTM, resolution=resolution, classes=classes, crs_wkt=crs_wkt,
+                            workers=workers)
+        with report.stage('sample_dtm') as record:
+            profiles = sample_profiles_from_dtm(output_DTM, transects)
+            record['count'] = len(profiles.z)
+    if 'points' in engines:
+        with report.stage('sample_points') as record:
+            point_profiles = sample_profiles_from_points(las_files, transects, classes)
+            record['count'] = len(point_profiles.z)
+        if profiles is None:
+            profiles = point_profiles
+    if PARQUET_AVAILABLE:
+        with report.stage('profile_store', count=len(profiles)):
+            write_profile_store(profiles, os.path.join(folder, 'profiles.parquet'), width)
+    with report.stage('simplify') as record:
+        simplified = profiles.simplify(0.05)
+        record['count'] = len(simplified.z)
+    if graphs:
+        with report.stage('graphs') as record:
+            record['count'] = sum(1 for _ in render_profiles(simplified, folder, workers))
+    report.write(width=width, spacing=spacing, workers=workers)
+    return report
+
+
+def benchmark_cases(axes):
+    """
+    Cases of the benchmark: the first value of every axis is the baseline, every other value
+    of an axis is run with the baseline values of the other axes.
+    """
+    baseline = {name: values[0] for name, values in axes.items()}
+    cases = [baseline]
+    for name, values in axes.items():
+        for value in values[1:]:
+            case = dict(baseline, **{name: value})
+            if case not in cases:
+                cases.append(case)
+    return cases
+
+
+def version_label():
+    """Short hash of the git commit of this script, or 'local' outside of a git repository."""
+    try:
+        label = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=_script_folder,
+                               capture_output=True, text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        label = ''
+    return label or 'local'
+
+
+def read_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def append_results(path, rows):
+    existing = read_results(path)
+    #results of older versions without some of RESULT_FIELDS are rewritten with these fields empty
+    new_file = not existing or list(existing[0]) != RESULT_FIELDS
+    with open(path, 'w' if new_file else 'a', newline='') as f:
+        writer = csv.DictWriter(f, RESULT_FIELDS, restval='', extrasaction='ignore')
+        if new_file:
+            writer.writeheader()
+            writer.writerows(existing)
+        writer.writerows(rows)
+
+
+def compare_results(rows, label, baseline_label, threshold=1.2, log=print):
+    """
+    Compares the fastest wall time of every case and stage of label with baseline_label.
+    Returns the number of stages slower than threshold times the baseline.
+    """
+    def fastest(selected_label):
+        times = {}
+        for row in rows:
+            if row['label'] == selected_label:
+                key = (row['case'], row['stage'])
+                times[key] = min(times.get(key, float('inf')), float(row['wall']))
+        return times
+
+    current, baseline = fastest(label), fastest(baseline_label)
+    if not baseline:
+        log(f"No results of {baseline_label} to compare with")
+        return 0
+    slower = 0
+    log(f"{'case':<40} {'stage':<14} {baseline_label:>12} {label:>12}  ratio")
+    for key in sorted(current.keys() & baseline.keys()):
+        ratio = current[key] / baseline[key] if baseline[key] > 0 else float('inf')
+        flag = ''
+        if ratio > threshold:
+            flag = '  SLOWER'
+            slower += 1
+        log(f"{key[0]:<40} {key[1]:<14} {baseline[key]:>11.3f}s {current[key]:>11.3f}s  {ratio:.2f}{flag}")
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of the cross profiles pipeline on synthetic data.')
+    parser.add_argument('output', help='folder of fixtures, case outputs and benchmark_results.csv')
+    parser.add_argument('--points', type=int, nargs='+', default=[1000000], help='points of the whole fixture')
+    parser.add_argument('--length', type=float, nargs='+', default=[2000], help='river length [m]')
+    parser.add_argument('--width', type=float, nargs='+', default=[100], help='transect width to both sides [m]')
+    parser.add_argument('--spacing', type=float, nargs='+', default=[20], help='transect spacing [m]')
+    parser.add_argument('--workers', type=int, nargs='+', default=[os.cpu_count()])
+    parser.add_argument('--terrain', nargs='+', choices=list(TERRAINS), default=['meander'],
+                        help='valley of the fixture: meanders and width of the river channel')
+    parser.add_argument('--class-mix', type=parse_class_mix, default=CLASS_MIX,
+                        help='shares of classes outside the river channel, e.g. 2:0.6,3:0.1,5:0.2,6:0.1')
+    parser.add_argument('--engines', nargs='+', choices=['dtm', 'points'], default=['dtm', 'points'])
+    parser.add_argument('--repeat', type=int, default=1, help='runs of every case, the fastest run is compared')
+    parser.add_argument('--no-graphs', action='store_true')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--label', default=None, help='version label of the results (default git describe)')
+    parser.add_argument('--compare', default=None, help='label of earlier results to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2, help='ratio of wall times reported as slower')
+    parser.add_argument('--keep', action='store_true', help='keep DTM, profiles and graphs of the cases')
+    args = parser.parse_args(argv)
+
+    label = args.label or version_label()
+    results_path = os.path.join(args.output, 'benchmark_results.csv')
+    axes = {'points': args.points, 'length': args.length, 'width': args.width, 'spacing': args.spacing,
+            'workers': args.workers, 'terrain': args.terrain}
+    #the fixture is wide enough for the widest transects, so Width does not change the points
+    half_width = max(args.width) + 20
+    date = time.strftime('%Y-%m-%dT%H:%M:%S')
+    for case in benchmark_cases(axes):
+        name = '_'.join(f'{key}{value:g}' if isinstance(value, float) else f'{key}{value}'
+                        for key, value in case.items())
+        fixture = os.path.join(args.output, 'fixtures',
+                               f"p{case['points']}_l{case['length']:g}_h{half_width:g}_{case['terrain']}")
+        las_files, line_path = create_fixture(fixture, case['points'], case['length'], half_width, args.seed,
+                                              class_mix=args.class_mix, terrain=case['terrain'])
+        for repeat in range(args.repeat):
+            print(f"{name} run {repeat + 1}/{args.repeat}")
+            folder = os.path.join(args.output, 'cases', name)
+            report = benchmark_case(las_files, line_path, folder, case['width'], case['spacing'], case['workers'],
+                                    args.engines, not args.no_graphs)
+            rows = []
+            for record in report.stages:
+                print(f"  {record['stage']:<14} {record['wall']:>9.3f} s wall {record['cpu']:>9.3f} s CPU")
+                rows.append(dict({key: record.get(key) for key in RESULT_FIELDS}, label=label, date=date,
+                                 python=sys.version.split()[0], cpu_count=os.cpu_count(), case=name,
+                                 class_mix=format_class_mix(args.class_mix), repeat=repeat, **case))
+            append_results(results_path, rows)
+            if not args.keep:
+                shutil.rmtree(folder)
+    print(f"Results saved to {results_path}")
+
+    if args.compare:
+        return 1 if compare_results(read_results(results_path), label, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
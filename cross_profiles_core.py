@@ -0,0 +1,2231 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ -------------------
+        Name                 : cross_profiles_core
+        Begin                : 22/01/2024
+        Copyright            : (C) 2024 by k_hor
+        Email                : horvathova190@uniba.sk
+        Description:         : Helper functions of the Cross Profiles tool which do not depend on QGIS.\
+                               Keep this file in the same folder as cross_profiles_update.py.\
+                               The profile pipeline can also be run from this module without QGIS:
+                               python cross_profiles_core.py LAS_FOLDER LINE OUTPUT_FOLDER --width 100 --spacing 50
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import argparse
+import csv
+import hashlib
+import importlib.util
+import json
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class LasHeader:
+    """Values from the public header block of a LAS/LAZ file."""
+    path: str
+    version: tuple
+    point_format: int
+    compressed: bool
+    point_record_length: int
+    offset_to_points: int
+    header_size: int
+    vlr_count: int
+    point_count: int
+    scale: tuple
+    offset: tuple
+    bounds: tuple  # (min_x, min_y, max_x, max_y)
+    z_range: tuple  # (min_z, max_z)
+    copc: bool = False
+
+
+POINT_CLOUD_EXTENSIONS = ('.las', '.laz')
+# filter_las decompresses LAZ files with laspy and its lazrs or laszip backend
+LAZ_AVAILABLE = (importlib.util.find_spec('laspy') is not None
+                 and any(importlib.util.find_spec(backend) is not None for backend in ('lazrs', 'laszip')))
+
+
+def find_point_clouds(folder):
+    """LAS, LAZ and COPC (.copc.laz) files in a folder, sorted by name."""
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if name.lower().endswith(POINT_CLOUD_EXTENSIONS)
+                  and os.path.isfile(os.path.join(folder, name)))
+
+
+def read_las_header(path):
+    """Reads the public header block of a LAS/LAZ file without reading any points."""
+    with open(path, 'rb') as f:
+        # header of LAS 1.4 and the first VLR header, which is the COPC info VLR in COPC files
+        data = f.read(375 + 54)
+    if data[:4] != b'LASF':
+        raise ValueError(f"{path} is not a LAS file")
+
+    version = (data[24], data[25])
+    header_size, offset_to_points, vlr_count = struct.unpack_from('<HII', data, 94)
+    point_format, point_record_length, legacy_count = struct.unpack_from('<BHI', data, 104)
+    scale = struct.unpack_from('<3d', data, 131)
+    offset = struct.unpack_from('<3d', data, 155)
+    max_x, min_x, max_y, min_y, max_z, min_z = struct.unpack_from('<6d', data, 179)
+
+    point_count = legacy_count
+    if version >= (1, 4) and len(data) >= 255:
+        point_count = struct.unpack_from('<Q', data, 247)[0] or legacy_count
+    copc = vlr_count > 0 and len(data) >= header_size + 20 and data[header_size + 2:header_size + 6] == b'copc'
+
+    return LasHeader(
+        path=path,
+        version=version,
+        # bits 6 and 7 are set for LAZ compressed files
+        point_format=point_format & 0x3F,
+        compressed=bool(point_format & 0x80),
+        point_record_length=point_record_length,
+        offset_to_points=offset_to_points,
+        header_size=header_size,
+        vlr_count=vlr_count,
+        point_count=point_count,
+        scale=scale,
+        offset=offset,
+        bounds=(min_x, min_y, max_x, max_y),
+        z_range=(min_z, max_z),
+        copc=copc,
+    )
+
+
+def bounds_intersect(a, b):
+    """Checks whether two (min_x, min_y, max_x, max_y) boxes intersect."""
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def las_point_dtype(header):
+    """Numpy record type with coordinates and classification of the LAS point format."""
+    # formats 0-5 keep classification in the low 5 bits of byte 15, formats 6-10 in byte 16
+    classification_offset = 15 if header.point_format < 6 else 16
+    return np.dtype({'names': ['X', 'Y', 'Z', 'classification'],
+                     'formats': ['<i4', '<i4', '<i4', 'u1'],
+                     'offsets': [0, 4, 8, classification_offset],
+                     'itemsize': header.point_record_length})
+
+
+def _filter_points(x, y, z, classification, classes, bounds, region=None):
+    """Keeps points of the given classes inside bounds and inside region (see CellMask)."""
+    keep = np.ones(len(x), dtype=bool)
+    if classes is not None:
+        keep &= np.isin(classification, classes)
+    if bounds is not None:
+        keep &= (x >= bounds[0]) & (y >= bounds[1]) & (x <= bounds[2]) & (y <= bounds[3])
+    if region is not None:
+        keep[keep] = region.contains(x[keep], y[keep])
+    return x[keep], y[keep], z[keep]
+
+
+def _iter_laz_points(header, classes=None, bounds=None, chunk_size=2000000, resolution=None, progress=None,
+                     region=None):
+    """
+    Yields chunks (x, y, z) of points of a LAZ file read with laspy. From a COPC file only the octree nodes
+    intersecting bounds are decompressed, and only down to the level whose point spacing is finer than resolution.
+    """
+    try:
+        import laspy
+    except ImportError:
+        raise ImportError(f"Reading {header.path} needs laspy with a LAZ backend: pip install laspy[lazrs]")
+
+    if header.copc:
+        with laspy.CopcReader.open(header.path) as reader:
+            query_bounds = None
+            if bounds is not None:
+                query_bounds = laspy.copc.Bounds(mins=np.array([bounds[0], bounds[1], header.z_range[0]]),
+                                                 maxs=np.array([bounds[2], bounds[3], header.z_range[1]]))
+            points = reader.query(bounds=query_bounds, resolution=resolution or None)
+            chunks = [points] if len(points) else []
+    else:
+        reader = laspy.open(header.path)
+        chunks = reader.chunk_iterator(chunk_size)
+
+    done = 0
+    try:
+        for chunk in chunks:
+            yield _filter_points(np.asarray(chunk.x), np.asarray(chunk.y), np.asarray(chunk.z),
+                                 np.asarray(chunk.classification), classes, bounds, region)
+            done += len(chunk)
+            if progress is not None:
+                progress(min(done, header.point_count), header.point_count)
+    finally:
+        if not header.copc:
+            reader.close()
+
+
+def iter_las_points(path, classes=None, bounds=None, chunk_size=2000000, resolution=None, progress=None,
+                    region=None):
+    """
+    Yields x, y, z coordinates of points of a LAS, LAZ or COPC file in chunks, so a pass over a large file
+    holds only one chunk in memory. Uncompressed points are read through a memory map, compressed ones
+    through laspy. Only points of the given classes, inside bounds (min_x, min_y, max_x, max_y) and inside
+    region (CellMask of a corridor) are kept. resolution (metres) limits the level of detail read from
+    a COPC file. progress is called as progress(done, total) with points of the file read after every chunk.
+    """
+    header = read_las_header(path)
+    if bounds is not None and not bounds_intersect(header.bounds, bounds):
+        return
+    if classes is not None:
+        classes = np.asarray(list(classes), dtype=np.uint8)
+    if header.compressed:
+        yield from _iter_laz_points(header, classes, bounds, chunk_size, resolution, progress, region)
+        return
+
+    records = np.memmap(path, dtype=las_point_dtype(header), mode='r',
+                        offset=header.offset_to_points, shape=(header.point_count,))
+    class_mask = 0x1F if header.point_format < 6 else 0xFF
+    for start in range(0, header.point_count, chunk_size):
+        chunk = records[start:start + chunk_size]
+        x = chunk['X'] * header.scale[0] + header.offset[0]
+        y = chunk['Y'] * header.scale[1] + header.offset[1]
+        z = chunk['Z'] * header.scale[2] + header.offset[2]
+        yield _filter_points(x, y, z, chunk['classification'] & class_mask, classes, bounds, region)
+        if progress is not None:
+            progress(start + len(chunk), header.point_count)
+    del records
+
+
+def read_las_points(path, classes=None, bounds=None, chunk_size=2000000, resolution=None, progress=None,
+                    region=None):
+    """Reads x, y, z coordinates of the kept points of a LAS, LAZ or COPC file at once (see iter_las_points)."""
+    chunks = list(iter_las_points(path, classes, bounds, chunk_size, resolution, progress, region))
+    if not chunks:
+        return np.empty(0), np.empty(0), np.empty(0)
+    return tuple(np.concatenate([chunk[axis] for chunk in chunks]) for axis in range(3))
+
+
+def _files_progress(las_paths, progress):
+    """
+    Yields (path, progress of the file) for a pass over several LAS files, the progress of a file
+    is reported to progress(done, total) as points read over all files. Without progress yields None.
+    """
+    counts = [read_las_header(path).point_count for path in las_paths] if progress is not None else None
+    done = 0
+    for i, path in enumerate(las_paths):
+        if progress is None:
+            yield path, None
+            continue
+        yield path, lambda file_done, _, before=done: progress(before + file_done, sum(counts))
+        done += counts[i]
+
+
+def native_point_spacing(las_paths):
+    """Average point spacing estimated from the point count and extent in LAS headers."""
+    area = 0.0
+    count = 0
+    for path in las_paths:
+        header = read_las_header(path)
+        min_x, min_y, max_x, max_y = header.bounds
+        area += (max_x - min_x) * (max_y - min_y)
+        count += header.point_count
+    if count == 0:
+        return 1.0
+    return float(np.sqrt(area / count))
+
+
+def _read_vlrs(f, header):
+    """Yields (user_id, record_id, data) of the VLRs and EVLRs of an open LAS file."""
+    f.seek(header.header_size)
+    for _ in range(header.vlr_count):
+        record = f.read(54)
+        if len(record) < 54:
+            return
+        record_id, length = struct.unpack_from('<HH', record, 18)
+        yield record[2:18].rstrip(b'\0'), record_id, f.read(length)
+    if header.version < (1, 4):
+        return
+    f.seek(235)
+    start, count = struct.unpack('<QI', f.read(12))
+    if not start:
+        return
+    f.seek(start)
+    for _ in range(count):
+        record = f.read(60)
+        if len(record) < 60:
+            return
+        record_id, length = struct.unpack_from('<HQ', record, 18)
+        if record[2:18].rstrip(b'\0') == b'LASF_Projection':
+            yield b'LASF_Projection', record_id, f.read(length)
+        else:
+            f.seek(length, os.SEEK_CUR)
+
+
+def read_las_crs(header):
+    """
+    CRS of a LAS/LAZ file from its projection VLRs, as WKT or 'EPSG:code' from GeoTIFF keys.
+    Returns None when the file has no CRS. Points are not read.
+    """
+    with open(header.path, 'rb') as f:
+        epsg = None
+        for user_id, record_id, data in _read_vlrs(f, header):
+            if user_id != b'LASF_Projection':
+                continue
+            if record_id == 2112:
+                wkt = data.rstrip(b'\0').decode('utf-8', 'replace').strip()
+                if wkt:
+                    return wkt
+            elif record_id == 34735 and len(data) >= 8:
+                keys = np.frombuffer(data[:len(data) // 2 * 2], dtype='<u2')
+                # key entries (id, location, count, value) follow the 4 values of the directory header
+                for key_id, location, _, value in keys[4:4 + 4 * int(keys[3])].reshape(-1, 4):
+                    # projected CRS is preferred to geographic, location 0 means the value is in the entry
+                    if key_id in (3072, 2048) and location == 0 and 0 < value < 32767:
+                        if key_id == 3072 or epsg is None:
+                            epsg = int(value)
+    return f'EPSG:{epsg}' if epsg else None
+
+
+class TileIndex:
+    """
+    Index of the point cloud tiles of a folder stored next to them in tile_index.gpkg.
+    For every tile it keeps the bounds, point count and CRS read from the header and,
+    once they are needed, the counts of points by classification. Only new and changed tiles
+    are scanned, so later runs select tiles without opening them.
+    """
+
+    FILE_NAME = 'tile_index.gpkg'
+    LAYER = 'tiles'
+
+    def __init__(self, folder, path=None):
+        self.folder = folder
+        self.path = path or os.path.join(folder, self.FILE_NAME)
+        self.tiles = {}
+        self.scanned = 0
+        self.changed = False
+        self._load()
+        self.update()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+        import geopandas as gpd
+        try:
+            table = gpd.read_file(self.path, layer=self.LAYER, ignore_geometry=True)
+        except Exception:
+            # damaged index, all tiles are scanned again
+            return
+        for row in table.to_dict('records'):
+            self.tiles[row['name']] = {
+                'name': row['name'], 'size': int(row['size']), 'mtime_ns': int(row['mtime_ns']),
+                'point_count': int(row['point_count']), 'point_format': int(row['point_format']),
+                'compressed': bool(row['compressed']), 'copc': bool(row['copc']),
+                'bounds': (row['min_x'], row['min_y'], row['max_x'], row['max_y']),
+                'z_range': (row['min_z'], row['max_z']),
+                'crs': row['crs'] or None,
+                'classes': {int(k): v for k, v in json.loads(row['classes']).items()} if row['classes'] else None}
+
+    def update(self):
+        """Scans headers of new and changed tiles and forgets removed ones."""
+        present = {}
+        for path in find_point_clouds(self.folder):
+            stat = os.stat(path)
+            present[os.path.basename(path)] = (path, stat.st_size, stat.st_mtime_ns)
+        for name in set(self.tiles) - set(present):
+            del self.tiles[name]
+            self.changed = True
+        for name, (path, size, mtime_ns) in present.items():
+            tile = self.tiles.get(name)
+            if tile is not None and tile['size'] == size and tile['mtime_ns'] == mtime_ns:
+                continue
+            header = read_las_header(path)
+            self.tiles[name] = {
+                'name': name, 'size': size, 'mtime_ns': mtime_ns,
+                'point_count': header.point_count, 'point_format': header.point_format,
+                'compressed': header.compressed, 'copc': header.copc,
+                'bounds': header.bounds, 'z_range': header.z_range,
+                'crs': read_las_crs(header), 'classes': None}
+            self.scanned += 1
+            self.changed = True
+
+    def path_of(self, tile):
+        return os.path.join(self.folder, tile['name'])
+
+    def select(self, bounds=None):
+        """Tiles whose bounds intersect bounds (min_x, min_y, max_x, max_y), sorted by name."""
+        return [self.tiles[name] for name in sorted(self.tiles)
+                if bounds is None or bounds_intersect(self.tiles[name]['bounds'], bounds)]
+
+    def crs_groups(self, tiles=None):
+        """Tiles grouped by their CRS, tiles without CRS are under None."""
+        groups = {}
+        for tile in tiles if tiles is not None else self.select():
+            groups.setdefault(tile['crs'], []).append(tile)
+        return groups
+
+    def class_counts(self, tile):
+        """
+        Counts of points by classification of a tile kept in the index, None when they are not known yet.
+        They are collected by filter_las, the points are never read only to count them.
+        """
+        return tile['classes']
+
+    def set_class_counts(self, tile, counts):
+        """Keeps counts of points by classification (array of 256 counts) collected by a pass over the tile."""
+        tile['classes'] = {int(c): int(counts[c]) for c in np.flatnonzero(counts)}
+        self.changed = True
+
+    def save(self):
+        """Writes the index when it changed. The file is replaced at once, so parallel runs do not read it half written."""
+        if not self.changed:
+            return
+        import geopandas as gpd
+        from shapely.geometry import box
+        rows = [{'name': t['name'], 'size': t['size'], 'mtime_ns': t['mtime_ns'],
+                 'point_count': t['point_count'], 'point_format': t['point_format'],
+                 'compressed': t['compressed'], 'copc': t['copc'],
+                 'min_x': t['bounds'][0], 'min_y': t['bounds'][1], 'max_x': t['bounds'][2], 'max_y': t['bounds'][3],
+                 'min_z': t['z_range'][0], 'max_z': t['z_range'][1], 'crs': t['crs'] or '',
+                 'classes': json.dumps(t['classes']) if t['classes'] is not None else ''}
+                for t in self.select()]
+        crs_values = {t['crs'] for t in self.tiles.values()}
+        table = gpd.GeoDataFrame(rows, geometry=[box(*t['bounds']) for t in self.select()],
+                                 crs=crs_values.pop() if len(crs_values) == 1 else None)
+        temporary = f'{os.path.splitext(self.path)[0]}_{os.getpid()}.gpkg'
+        table.to_file(temporary, layer=self.LAYER, driver='GPKG')
+        os.replace(temporary, self.path)
+        self.changed = False
+
+
+def _box_count(mask, radius):
+    """Number of set cells in the (2 * radius + 1) square window around every cell."""
+    size = 2 * radius + 1
+    # summed area table in int32 computed in place, the grid has fewer cells than Footprint.MAX_CELLS
+    sums = np.pad(mask, ((radius + 1, radius), (radius + 1, radius))).astype(np.int32)
+    np.cumsum(sums, axis=0, out=sums)
+    np.cumsum(sums, axis=1, out=sums)
+    return sums[size:, size:] - sums[:-size, size:] - sums[size:, :-size] + sums[:-size, :-size]
+
+
+def close_mask(mask, radius):
+    """Morphological closing of a boolean grid with a square of radius cells, fills gaps narrower than 2 * radius."""
+    if radius <= 0:
+        return mask
+    padded = np.pad(mask, radius)
+    dilated = _box_count(padded, radius) > 0
+    closed = _box_count(dilated, radius) == (2 * radius + 1) ** 2
+    return closed[radius:-radius, radius:-radius]
+
+
+class Footprint:
+    """
+    Occupancy grid of points over bounds (min_x, min_y, max_x, max_y). Cells with points are marked
+    while points are read and the grid is written as polygons of the data footprint.
+    For large extents the cell is made coarser, so the grid has at most MAX_CELLS cells.
+    """
+
+    # 600 km2 survey blocks get cells of about 5 m instead of 150 million 2 m cells
+    MAX_CELLS = 25000000
+
+    def __init__(self, bounds, cell_size=2.0):
+        area = max(bounds[2] - bounds[0], 0.0) * max(bounds[3] - bounds[1], 0.0)
+        self.cell_size = max(float(cell_size), math.sqrt(area / self.MAX_CELLS))
+        self.origin_x = bounds[0]
+        self.top_y = bounds[3]
+        self.cols = int((bounds[2] - bounds[0]) // self.cell_size) + 1
+        self.rows = int((bounds[3] - bounds[1]) // self.cell_size) + 1
+        self.occupied = np.zeros((self.rows, self.cols), dtype=bool)
+
+    def add(self, x, y):
+        cols = np.clip((x - self.origin_x) // self.cell_size, 0, self.cols - 1).astype(np.int64)
+        rows = np.clip((self.top_y - y) // self.cell_size, 0, self.rows - 1).astype(np.int64)
+        self.occupied[rows, cols] = True
+
+    def write(self, path, close_distance=50.0, crs_wkt=None):
+        """
+        Writes the footprint polygons to a shapefile. Gaps narrower than close_distance (river surface
+        without ground points, buildings) are closed, larger holes and disjoint parts are kept.
+        """
+        from osgeo import gdal, ogr, osr
+        mask = close_mask(self.occupied, int(round(close_distance / 2 / self.cell_size)))
+        raster = gdal.GetDriverByName('MEM').Create('', self.cols, self.rows, 1, gdal.GDT_Byte)
+        raster.SetGeoTransform((self.origin_x, self.cell_size, 0, self.top_y, 0, -self.cell_size))
+        band = raster.GetRasterBand(1)
+        band.WriteArray(mask.astype(np.uint8))
+
+        spatial_ref = None
+        if crs_wkt:
+            spatial_ref = osr.SpatialReference()
+            spatial_ref.SetFromUserInput(crs_wkt)
+        driver = ogr.GetDriverByName('ESRI Shapefile')
+        if os.path.exists(path):
+            driver.DeleteDataSource(path)
+        dataset = driver.CreateDataSource(path)
+        layer = dataset.CreateLayer('boundary', spatial_ref, ogr.wkbPolygon)
+        layer.CreateField(ogr.FieldDefn('DN', ogr.OFTInteger))
+        # band is its own mask, so only the occupied cells become polygons
+        gdal.Polygonize(band, band, layer, 0, ['8CONNECTED=8'])
+        dataset = None
+        raster = None
+
+
+def filter_las_supported(las_paths):
+    """Whether filter_las can read the files in one pass: one point format, LAZ files only with laspy."""
+    headers = [read_las_header(path) for path in las_paths]
+    return (len({(h.point_format, h.point_record_length) for h in headers}) == 1
+            and (LAZ_AVAILABLE or not any(h.compressed for h in headers)))
+
+
+def _iter_point_records(header, chunk_size=2000000):
+    """
+    Yields chunks (records, X, Y, Z, classification, return_number) of all points of a LAS/LAZ file,
+    records are the uncompressed point records and X, Y, Z the integer coordinates. Uncompressed points
+    are read through a memory map, compressed ones are decompressed with laspy.
+    """
+    if header.compressed:
+        try:
+            import laspy
+        except ImportError:
+            raise ImportError(f"Reading {header.path} needs laspy with a LAZ backend: pip install laspy[lazrs]")
+        with laspy.open(header.path) as reader:
+            for chunk in reader.chunk_iterator(chunk_size):
+                array = np.ascontiguousarray(chunk.array)
+                if array.dtype.itemsize != header.point_record_length:
+                    raise ValueError(f"{header.path}: laspy reads records of {array.dtype.itemsize} bytes, "
+                                     f"the header has {header.point_record_length}")
+                yield (array.view(np.dtype((np.void, array.dtype.itemsize))),
+                       np.asarray(chunk.X), np.asarray(chunk.Y), np.asarray(chunk.Z),
+                       np.asarray(chunk.classification, dtype=np.uint8), np.asarray(chunk.return_number, dtype=np.uint8))
+        return
+
+    fields = las_point_dtype(header).fields
+    dtype = np.dtype({'names': ['X', 'Y', 'Z', 'classification', 'returns'],
+                      'formats': ['<i4', '<i4', '<i4', 'u1', 'u1'],
+                      'offsets': [fields[name][1] for name in ('X', 'Y', 'Z', 'classification')] + [14],
+                      'itemsize': header.point_record_length})
+    records = np.memmap(header.path, dtype=dtype, mode='r', offset=header.offset_to_points, shape=(header.point_count,))
+    raw = np.memmap(header.path, dtype=np.dtype((np.void, header.point_record_length)), mode='r',
+                    offset=header.offset_to_points, shape=(header.point_count,))
+    class_mask = 0x1F if header.point_format < 6 else 0xFF
+    return_mask = 0x07 if header.point_format < 6 else 0x0F
+    for start in range(0, header.point_count, chunk_size):
+        chunk = records[start:start + chunk_size]
+        yield (raw[start:start + chunk_size], chunk['X'], chunk['Y'], chunk['Z'],
+               chunk['classification'] & class_mask, chunk['returns'] & return_mask)
+    del records, raw
+
+
+def _uncompressed_prefix(header):
+    """
+    Header with VLRs and the EVLRs of a LAS/LAZ file for a copy with uncompressed points.
+    LASzip and COPC records of a compressed file are left out, they describe the compressed points.
+    """
+    def kept(record):
+        return not header.compressed or record[2:18].rstrip(b'\0') not in (b'laszip encoded', b'copc')
+
+    with open(header.path, 'rb') as f:
+        prefix = bytearray(f.read(header.header_size))
+        vlrs = []
+        for _ in range(header.vlr_count):
+            record = f.read(54)
+            if len(record) < 54:
+                break
+            data = f.read(struct.unpack_from('<H', record, 20)[0])
+            if kept(record):
+                vlrs.append(record + data)
+        evlrs = []
+        if header.version >= (1, 4):
+            f.seek(235)
+            start, count = struct.unpack('<QI', f.read(12))
+            if start:
+                f.seek(start)
+                for _ in range(count):
+                    record = f.read(60)
+                    if len(record) < 60:
+                        break
+                    data = f.read(struct.unpack_from('<Q', record, 20)[0])
+                    if kept(record):
+                        evlrs.append(record + data)
+    # point format without the compression bits, offset to points and number of VLRs of the copy
+    prefix[104] = header.point_format
+    struct.pack_into('<II', prefix, 96, header.header_size + sum(len(vlr) for vlr in vlrs), len(vlrs))
+    return bytes(prefix) + b''.join(vlrs), evlrs
+
+
+def filter_las(las_paths, output_path, classes, footprint_path=None, cell_size=2.0, close_distance=50.0,
+               crs_wkt=None, chunk_size=2000000, histogram=None, region=None, progress=None):
+    """
+    Writes points of the given classes from LAS/LAZ files to one uncompressed LAS file, so the tiles
+    are filtered without merging them first. In the same pass over the points the footprint of the written
+    points is collected and saved to footprint_path (see Footprint.write) and histogram (int64 array
+    of shape (len(las_paths), 256)) is filled with counts of points by class of every file.
+    Without output_path only the footprint and histogram are collected. Only points inside region
+    (CellMask of a corridor) are kept. Header and VLRs of the first file are copied, point counts and bounds
+    are updated, points of files with another scale or offset are re-encoded. The files must have one point
+    format (see filter_las_supported). Returns the number of kept points. progress is called as
+    progress(done, total) after every chunk of points, an exception raised by it stops the pass.
+    """
+    if isinstance(las_paths, str):
+        las_paths = [las_paths]
+    headers = [read_las_header(path) for path in las_paths]
+    first = headers[0]
+    if any((h.point_format, h.point_record_length) != (first.point_format, first.point_record_length) for h in headers):
+        raise ValueError("LAS files have different point formats, they can not be filtered into one file")
+    classes = np.asarray(list(classes), dtype=np.uint8)
+    footprint = None
+    if footprint_path:
+        footprint = Footprint((min(h.bounds[0] for h in headers), min(h.bounds[1] for h in headers),
+                               max(h.bounds[2] for h in headers), max(h.bounds[3] for h in headers)), cell_size)
+
+    total = sum(h.point_count for h in headers)
+    done = 0
+    count = 0
+    returns = np.zeros(16, dtype=np.int64)
+    low = np.full(3, np.inf)
+    high = np.full(3, -np.inf)
+    prefix, evlrs = _uncompressed_prefix(first) if output_path else (b'', [])
+    with open(output_path, 'wb') if output_path else nullcontext() as out:
+        if out is not None:
+            out.write(prefix)
+        for index, header in enumerate(headers):
+            encoded = header.scale == first.scale and header.offset == first.offset
+            for records, X, Y, Z, classification, return_number in _iter_point_records(header, chunk_size):
+                if histogram is not None:
+                    histogram[index] += np.bincount(classification, minlength=256)
+                keep = np.isin(classification, classes)
+                x = X[keep] * header.scale[0] + header.offset[0]
+                y = Y[keep] * header.scale[1] + header.offset[1]
+                if region is not None:
+                    inside = region.contains(x, y)
+                    keep[keep] = inside
+                    x, y = x[inside], y[inside]
+                done += len(records)
+                if progress is not None:
+                    progress(done, total)
+                if not len(x):
+                    continue
+                z = Z[keep] * header.scale[2] + header.offset[2]
+                count += len(x)
+                returns += np.bincount(return_number[keep], minlength=16)
+                for axis, values in enumerate((x, y, z)):
+                    low[axis] = min(low[axis], values.min())
+                    high[axis] = max(high[axis], values.max())
+                if footprint is not None:
+                    footprint.add(x, y)
+                if out is None:
+                    continue
+                selected = records[keep]
+                if not encoded:
+                    # X, Y, Z are the first 12 bytes of every point format
+                    data = np.frombuffer(bytearray(selected.tobytes()), dtype=np.uint8).reshape(len(selected), -1)
+                    coordinates = (np.column_stack([x, y, z]) - np.array(first.offset)) / np.array(first.scale)
+                    data[:, :12] = np.round(coordinates).astype('<i4').view(np.uint8)
+                    selected = data
+                out.write(selected.tobytes())
+        if out is not None:
+            evlr_start = out.tell()
+            out.write(b''.join(evlrs))
+
+    if output_path:
+        if not count:
+            low = high = [0.0, 0.0, 0.0]
+        legacy = first.point_format < 6 and count <= 0xFFFFFFFF
+        with open(output_path, 'r+b') as out:
+            out.seek(107)
+            out.write(struct.pack('<I5I', count if legacy else 0, *(returns[1:6] if legacy else [0] * 5)))
+            out.seek(179)
+            out.write(struct.pack('<6d', high[0], low[0], high[1], low[1], high[2], low[2]))
+            if first.version >= (1, 4):
+                out.seek(235)
+                out.write(struct.pack('<QI', evlr_start if evlrs else 0, len(evlrs)))
+                out.seek(247)
+                out.write(struct.pack('<Q15Q', count, *returns[1:16]))
+
+    if footprint is not None:
+        footprint.write(footprint_path, close_distance, crs_wkt)
+    return count
+
+
+def las_footprint(las_paths, footprint_path, classes=None, cell_size=2.0, close_distance=50.0, crs_wkt=None,
+                  progress=None):
+    """
+    Writes the footprint of points of the given classes in LAS/LAZ files (see Footprint.write).
+    progress is called as progress(done, total) with points read over all files.
+    """
+    headers = [read_las_header(path) for path in las_paths]
+    footprint = Footprint((min(h.bounds[0] for h in headers), min(h.bounds[1] for h in headers),
+                           max(h.bounds[2] for h in headers), max(h.bounds[3] for h in headers)), cell_size)
+    for path, file_progress in _files_progress(las_paths, progress):
+        for x, y, _ in iter_las_points(path, classes, progress=file_progress):
+            footprint.add(x, y)
+    footprint.write(footprint_path, close_distance, crs_wkt)
+
+
+def _cells_along(grid, x0, y0, x1, y1, radius):
+    """Ids of the cells of grid (origin_x, origin_y, cell_size, nx, ny) closer than radius to a segment."""
+    length = np.hypot(x1 - x0, y1 - y0)
+    t = np.linspace(0.0, 1.0, max(int(np.ceil(length / (grid.cell_size / 2))), 1) + 1)
+    ix = ((x0 + t * (x1 - x0) - grid.origin_x) // grid.cell_size).astype(np.int64)
+    iy = ((y0 + t * (y1 - y0) - grid.origin_y) // grid.cell_size).astype(np.int64)
+    reach = int(np.ceil(radius / grid.cell_size))
+    dx, dy = np.meshgrid(np.arange(-reach, reach + 1), np.arange(-reach, reach + 1))
+    ix = (ix[:, None] + dx.ravel()[None, :]).ravel()
+    iy = (iy[:, None] + dy.ravel()[None, :]).ravel()
+    inside = (ix >= 0) & (iy >= 0) & (ix < grid.nx) & (iy < grid.ny)
+    return np.unique(iy[inside] * grid.nx + ix[inside])
+
+
+class CellMask:
+    """
+    Corridor of cells of a coarse grid over bounds (min_x, min_y, max_x, max_y) marked around segments.
+    Points are tested against it while they are read, so only the points around transects are kept
+    instead of all points in the bounding box of a diagonal or meandering reach.
+    """
+
+    # the cell grows for large extents, so the mask stays below this number of cells (16 MB)
+    MAX_CELLS = 16000000
+
+    def __init__(self, bounds, cell_size):
+        area = max(bounds[2] - bounds[0], 0.0) * max(bounds[3] - bounds[1], 0.0)
+        self.cell_size = max(float(cell_size), math.sqrt(area / self.MAX_CELLS))
+        self.origin_x, self.origin_y = bounds[0], bounds[1]
+        self.nx = int((bounds[2] - bounds[0]) // self.cell_size) + 1
+        self.ny = int((bounds[3] - bounds[1]) // self.cell_size) + 1
+        self.cells = np.zeros(self.nx * self.ny, dtype=bool)
+
+    @classmethod
+    def from_polygons(cls, path, cell_size):
+        """Mask of the cells touched by the polygons of the first layer of a vector file (e.g. corridor.shp)."""
+        from osgeo import gdal, ogr
+        dataset = ogr.Open(path)
+        layer = dataset.GetLayer(0)
+        min_x, max_x, min_y, max_y = layer.GetExtent()
+        mask = cls((min_x, min_y, max_x, max_y), cell_size)
+        raster = gdal.GetDriverByName('MEM').Create('', mask.nx, mask.ny, 1, gdal.GDT_Byte)
+        raster.SetGeoTransform((mask.origin_x, mask.cell_size, 0, mask.origin_y + mask.ny * mask.cell_size, 0,
+                                -mask.cell_size))
+        gdal.RasterizeLayer(raster, [1], layer, burn_values=[1], options=['ALL_TOUCHED=TRUE'])
+        # raster rows run from the north, cell ids of the mask from the south
+        mask.cells = raster.GetRasterBand(1).ReadAsArray()[::-1].astype(bool).ravel()
+        return mask
+
+    def add_segment(self, x0, y0, x1, y1, radius):
+        self.cells[_cells_along(self, x0, y0, x1, y1, radius)] = True
+
+    def contains(self, x, y):
+        ix = ((x - self.origin_x) // self.cell_size).astype(np.int64)
+        iy = ((y - self.origin_y) // self.cell_size).astype(np.int64)
+        inside = (ix >= 0) & (iy >= 0) & (ix < self.nx) & (iy < self.ny)
+        result = np.zeros(len(x), dtype=bool)
+        result[inside] = self.cells[iy[inside] * self.nx + ix[inside]]
+        return result
+
+
+class GridIndex:
+    """
+    Grid bucket spatial index over points. Points are sorted by the cell they fall in,
+    so the points of one cell (and of a run of cells in one grid row) are a contiguous slice.
+    """
+
+    def __init__(self, x, y, cell_size):
+        self.cell_size = float(cell_size)
+        self.origin_x = float(x.min()) if len(x) else 0.0
+        self.origin_y = float(y.min()) if len(y) else 0.0
+        ix = ((x - self.origin_x) // self.cell_size).astype(np.int64)
+        iy = ((y - self.origin_y) // self.cell_size).astype(np.int64)
+        self.nx = int(ix.max()) + 1 if len(x) else 1
+        self.ny = int(iy.max()) + 1 if len(y) else 1
+        cell_id = iy * self.nx + ix
+        self.order = np.argsort(cell_id, kind='stable')
+        counts = np.bincount(cell_id, minlength=self.nx * self.ny)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def cells_along(self, x0, y0, x1, y1, radius):
+        """Ids of the cells closer than radius to the segment (x0, y0)-(x1, y1)."""
+        return _cells_along(self, x0, y0, x1, y1, radius)
+
+    def points_in_cells(self, cell_ids):
+        """Indices of the points in the given cells."""
+        starts = self.offsets[cell_ids]
+        lengths = self.offsets[cell_ids + 1] - starts
+        total = int(lengths.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64)
+        # concatenated ranges starts[i]:starts[i] + lengths[i] without a Python loop
+        shift = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        return self.order[shift + np.arange(total)]
+
+
+class ProfileArrays:
+    """
+    Samples of all profiles in contiguous numpy arrays sorted by profile ID and distance.
+    Samples of the i-th profile ids[i] are dist[offsets[i]:offsets[i + 1]] (and the same for z, x, y).
+    """
+
+    def __init__(self, ids, offsets, dist, z, x=None, y=None):
+        self.ids = np.asarray(ids)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.dist = np.asarray(dist, dtype=np.float64)
+        self.z = np.asarray(z, dtype=np.float64)
+        self.x = None if x is None else np.asarray(x, dtype=np.float64)
+        self.y = None if y is None else np.asarray(y, dtype=np.float64)
+
+    @classmethod
+    def from_columns(cls, profile_ids, dist, z, x=None, y=None):
+        """Builds profiles from per-sample columns in any order."""
+        profile_ids = np.asarray(profile_ids)
+        dist = np.asarray(dist, dtype=np.float64)
+        order = np.lexsort((dist, profile_ids))
+        sorted_ids = profile_ids[order]
+        ids, starts = np.unique(sorted_ids, return_index=True)
+        return cls(ids, np.append(starts, len(sorted_ids)), dist[order], np.asarray(z)[order],
+                   None if x is None else np.asarray(x)[order],
+                   None if y is None else np.asarray(y)[order])
+
+    @classmethod
+    def concatenate(cls, parts):
+        """Joins ProfileArrays with different profile IDs, profiles are sorted by ID."""
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            return cls([], [0], [], [])
+        with_xy = all(part.x is not None for part in parts)
+        ids = np.concatenate([part.ids for part in parts])
+        lengths = np.concatenate([np.diff(part.offsets) for part in parts])
+        starts = np.concatenate([[0], np.cumsum(lengths)])[:-1]
+        order = np.argsort(ids, kind='stable')
+        index = np.concatenate([np.arange(starts[i], starts[i] + lengths[i]) for i in order])
+
+        def join(name):
+            return np.concatenate([getattr(part, name) for part in parts])[index]
+        return cls(ids[order], np.concatenate([[0], np.cumsum(lengths[order])]), join('dist'), join('z'),
+                   join('x') if with_xy else None, join('y') if with_xy else None)
+
+    def subset(self, keep):
+        """Profiles whose flag in the boolean array keep (one per profile) is True."""
+        lengths = np.diff(self.offsets)[keep]
+        index = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in np.flatnonzero(keep)]
+                               + [np.empty(0, dtype=np.int64)])
+        return ProfileArrays(self.ids[keep], np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]),
+                             self.dist[index], self.z[index],
+                             None if self.x is None else self.x[index],
+                             None if self.y is None else self.y[index])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        """Yields (id, dist, z) of every profile, dist and z are views into the arrays."""
+        for i, profile_id in enumerate(self.ids):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            yield profile_id, self.dist[start:end], self.z[start:end]
+
+    def simplify(self, tolerance):
+        """Profiles with samples thinned by simplify_profile, tolerance is vertical in metres."""
+        if tolerance <= 0:
+            return self
+        kept = [self.offsets[i] + simplify_profile(dist, z, tolerance)
+                for i, (_, dist, z) in enumerate(self)]
+        index = np.concatenate(kept) if kept else np.empty(0, dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum([len(k) for k in kept], dtype=np.int64)])
+        return ProfileArrays(self.ids, offsets, self.dist[index], self.z[index],
+                             None if self.x is None else self.x[index],
+                             None if self.y is None else self.y[index])
+
+    def columns(self):
+        """Per-sample columns ID, DIST, X, Y, Z (X and Y only when known)."""
+        columns = {'ID': np.repeat(self.ids, np.diff(self.offsets)), 'DIST': self.dist}
+        if self.x is not None:
+            columns['X'] = self.x
+            columns['Y'] = self.y
+        columns['Z'] = self.z
+        return columns
+
+
+def bank_samples(z):
+    """Indices (left bank, thalweg, right bank) of a profile: the lowest sample and the highest sample on each side of it."""
+    thalweg = int(np.argmin(z))
+    return int(np.argmax(z[:thalweg + 1])), thalweg, thalweg + int(np.argmax(z[thalweg:]))
+
+
+def simplify_profile(dist, z, tolerance):
+    """
+    Indices of profile samples kept by Douglas-Peucker simplification with a vertical tolerance:
+    removed samples are closer than tolerance (in elevation) to the line between kept samples.
+    Ends, thalweg (lowest sample) and the highest sample on both sides of it (banks) are always kept.
+    """
+    count = len(dist)
+    if count <= 2 or tolerance <= 0:
+        return np.arange(count)
+    left_bank, thalweg, right_bank = bank_samples(z)
+    anchors = sorted({0, left_bank, thalweg, right_bank, count - 1})
+    keep = np.zeros(count, dtype=bool)
+    keep[anchors] = True
+
+    stack = list(zip(anchors[:-1], anchors[1:]))
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        span = dist[end] - dist[start]
+        t = (dist[start + 1:end] - dist[start]) / span if span > 0 else 0.0
+        error = np.abs(z[start + 1:end] - (z[start] + t * (z[end] - z[start])))
+        i = int(np.argmax(error))
+        if error[i] > tolerance:
+            split = start + 1 + i
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return np.flatnonzero(keep)
+
+
+def _interpolate_nearest(along, across, z, stations, radius):
+    values = np.full(len(stations), np.nan)
+    for start in range(0, len(stations), 256):
+        block = stations[start:start + 256]
+        d2 = (along[None, :] - block[:, None]) ** 2 + across[None, :] ** 2
+        nearest = np.argmin(d2, axis=1)
+        found = d2[np.arange(len(block)), nearest] <= radius ** 2
+        values[start:start + 256][found] = z[nearest[found]]
+    return values
+
+
+def _interpolate_idw(along, across, z, stations, radius, power=2):
+    values = np.full(len(stations), np.nan)
+    for start in range(0, len(stations), 256):
+        block = stations[start:start + 256]
+        d2 = (along[None, :] - block[:, None]) ** 2 + across[None, :] ** 2
+        weights = np.where(d2 <= radius ** 2, 1.0 / np.maximum(d2, 1e-12) ** (power / 2), 0.0)
+        weight_sum = weights.sum(axis=1)
+        found = weight_sum > 0
+        values[start:start + 256][found] = (weights[found] @ z) / weight_sum[found]
+    return values
+
+
+def _interpolate_tin(along, across, z, stations):
+    from matplotlib.tri import Triangulation, LinearTriInterpolator
+    try:
+        triangulation = Triangulation(along, across)
+    except (RuntimeError, ValueError):
+        # fewer than 3 points or all points collinear
+        return np.full(len(stations), np.nan)
+    values = LinearTriInterpolator(triangulation, z)(stations, np.zeros(len(stations)))
+    return np.ma.filled(values, np.nan)
+
+
+def sample_profiles_from_points(las_paths, transects, classes=None, step=None,
+                                interpolation='idw', radius=None, progress=None):
+    """
+    Samples elevation profiles along transects directly from classified points.
+
+    transects is a list of (profile_id, (x0, y0), (x1, y1)). Elevations are sampled every step
+    metres (native point spacing by default) with nearest, idw or tin interpolation from points
+    closer than radius to the transect. Returns ProfileArrays, samples without points
+    around them are left out. progress is called as progress(done, total) for every transect.
+    """
+    if step is None or step <= 0:
+        step = native_point_spacing(las_paths)
+    if radius is None or radius <= 0:
+        radius = 2 * step
+
+    x_min = min(min(a[0], b[0]) for _, a, b in transects) - radius
+    y_min = min(min(a[1], b[1]) for _, a, b in transects) - radius
+    x_max = max(max(a[0], b[0]) for _, a, b in transects) + radius
+    y_max = max(max(a[1], b[1]) for _, a, b in transects) + radius
+    # only points in the corridor of cells around the transects are kept, not the whole bounding box
+    corridor = CellMask((x_min, y_min, x_max, y_max), max(radius, step))
+    for _, (x0, y0), (x1, y1) in transects:
+        corridor.add_segment(x0, y0, x1, y1, radius)
+    parts = [read_las_points(path, classes, (x_min, y_min, x_max, y_max), resolution=step, region=corridor)
+             for path in las_paths]
+    px = np.concatenate([p[0] for p in parts])
+    py = np.concatenate([p[1] for p in parts])
+    pz = np.concatenate([p[2] for p in parts])
+    index = GridIndex(px, py, max(radius, step))
+
+    result = {'ID': [], 'DIST': [], 'X': [], 'Y': [], 'Z': []}
+    offsets = [0]
+    for done, (profile_id, (x0, y0), (x1, y1)) in enumerate(transects):
+        if progress is not None:
+            progress(done, len(transects))
+        length = np.hypot(x1 - x0, y1 - y0)
+        if length == 0:
+            continue
+        ux, uy = (x1 - x0) / length, (y1 - y0) / length
+        candidates = index.points_in_cells(index.cells_along(x0, y0, x1, y1, radius))
+        along = (px[candidates] - x0) * ux + (py[candidates] - y0) * uy
+        across = (py[candidates] - y0) * ux - (px[candidates] - x0) * uy
+        band = (np.abs(across) <= radius) & (along >= -radius) & (along <= length + radius)
+        along, across, z = along[band], across[band], pz[candidates][band]
+
+        stations = np.linspace(0.0, length, int(length // step) + 1)
+        if len(z) == 0:
+            continue
+        if interpolation == 'nearest':
+            values = _interpolate_nearest(along, across, z, stations, radius)
+        elif interpolation == 'tin':
+            values = _interpolate_tin(along, across, z, stations)
+        else:
+            values = _interpolate_idw(along, across, z, stations, radius)
+
+        found = ~np.isnan(values)
+        if not found.any():
+            continue
+        result['ID'].append(profile_id)
+        offsets.append(offsets[-1] + int(found.sum()))
+        result['DIST'].append(stations[found])
+        result['X'].append(x0 + stations[found] * ux)
+        result['Y'].append(y0 + stations[found] * uy)
+        result['Z'].append(values[found])
+
+    columns = {key: np.concatenate(value) if value else np.empty(0) for key, value in result.items() if key != 'ID'}
+    return ProfileArrays(result['ID'], offsets, columns['DIST'], columns['Z'], columns['X'], columns['Y'])
+
+
+def write_profile_points(profiles, path, crs):
+    """Writes ProfileArrays as a point layer with ID, DIST, X, Y, Z fields (same as SAGA profile.shp)."""
+    import geopandas as gpd
+    columns = profiles.columns()
+    gdf = gpd.GeoDataFrame(columns, geometry=gpd.points_from_xy(columns['X'], columns['Y']), crs=crs)
+    gdf.to_file(path)
+
+
+def read_profile_points(path):
+    """Reads a point layer written by write_profile_points into ProfileArrays."""
+    import geopandas as gpd
+    gdf = gpd.read_file(path, ignore_geometry=True)
+    return ProfileArrays.from_columns(gdf['ID'].to_numpy(), gdf['DIST'].to_numpy(), gdf['Z'].to_numpy(),
+                                      gdf['X'].to_numpy(), gdf['Y'].to_numpy())
+
+
+# pyarrow is optional, without it the profile store is not written
+PARQUET_AVAILABLE = importlib.util.find_spec('pyarrow') is not None
+
+
+def write_profile_store(profiles, path, width=None, chainage=None, crs=None, reaches=None):
+    """
+    Writes ProfileArrays to a Parquet file with columns ID, REACH, CHAINAGE, DIST, OFFSET, X, Y, Z.
+    DIST is the distance from the start of the transect, OFFSET the signed distance from the river line
+    (DIST - width, transects reach width to both sides) and CHAINAGE the position of the profile
+    along its reach of the river line, given by the chainage and reaches mappings of profile IDs. Every profile is one row group,
+    their indices are in the file metadata, so one profile can be read without scanning the rest
+    (see read_profile_store). Needs pyarrow.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([('ID', pa.int64()), ('REACH', pa.string()), ('CHAINAGE', pa.float64()), ('DIST', pa.float64()),
+                        ('OFFSET', pa.float64()), ('X', pa.float64()), ('Y', pa.float64()), ('Z', pa.float64())])
+    schema = schema.with_metadata({
+        'profile_row_groups': json.dumps({str(int(profile_id)): i for i, profile_id in enumerate(profiles.ids)}),
+        'crs': crs or ''})
+    empty = np.full(len(profiles.dist), np.nan)
+    x = profiles.x if profiles.x is not None else empty
+    y = profiles.y if profiles.y is not None else empty
+    offset = profiles.dist - width if width is not None else empty
+
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with pq.ParquetWriter(temporary, schema, compression='zstd') as writer:
+        for i, profile_id in enumerate(profiles.ids):
+            start, end = profiles.offsets[i], profiles.offsets[i + 1]
+            profile_chainage = chainage.get(profile_id, np.nan) if chainage is not None else np.nan
+            reach = reaches.get(profile_id) if reaches is not None else None
+            writer.write_table(pa.table([np.full(end - start, int(profile_id), dtype=np.int64),
+                                         pa.array([None if reach is None else str(reach)] * (end - start), pa.string()),
+                                         np.full(end - start, profile_chainage, dtype=np.float64),
+                                         profiles.dist[start:end], offset[start:end],
+                                         x[start:end], y[start:end], profiles.z[start:end]], schema=schema))
+    os.replace(temporary, path)
+    return path
+
+
+def read_profile_store(path, profile_ids=None):
+    """Reads profiles (all or the given IDs) from a Parquet profile store into ProfileArrays."""
+    import pyarrow.parquet as pq
+    store = pq.ParquetFile(path)
+    row_groups = json.loads(store.schema_arrow.metadata[b'profile_row_groups'])
+    if profile_ids is None:
+        ids = sorted(row_groups, key=row_groups.get)
+    else:
+        ids = [str(int(profile_id)) for profile_id in profile_ids if str(int(profile_id)) in row_groups]
+    table = store.read_row_groups([row_groups[profile_id] for profile_id in ids], columns=['DIST', 'X', 'Y', 'Z'])
+    lengths = [store.metadata.row_group(row_groups[profile_id]).num_rows for profile_id in ids]
+    columns = {name: table.column(name).to_numpy() for name in ('DIST', 'X', 'Y', 'Z')}
+    return ProfileArrays(np.array([int(profile_id) for profile_id in ids], dtype=np.int64),
+                         np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]),
+                         columns['DIST'], columns['Z'], columns['X'], columns['Y'])
+
+
+CROSS_SECTION_FORMATS = ('sdf', 'csv')
+
+
+def reach_centerline(parts):
+    """
+    Centerline of a reach for the cross section export: vertices of all its parts in order and their
+    distance along the reach, measured like the chainage of transects (gaps between parts are not counted).
+    Returns (vertices, chainage), the length of the reach is chainage[-1].
+    """
+    vertices, chainage = [], []
+    start = 0.0
+    for part in parts:
+        part = np.asarray(part, dtype=np.float64)
+        along = start + np.concatenate([[0.0], np.cumsum(np.hypot(*np.diff(part, axis=0).T))])
+        vertices.append(part)
+        chainage.append(along)
+        start = float(along[-1])
+    return np.vstack(vertices), np.concatenate(chainage)
+
+
+def _bank_positions(dist, z):
+    """
+    Left and right bank of a cross section as fractions of its cut line (see bank_samples),
+    the same samples are kept by profile simplification.
+    """
+    if len(z) < 2 or dist[-1] <= dist[0]:
+        return 0.0, 1.0
+    left, _, right = bank_samples(z)
+    length = dist[-1] - dist[0]
+    return (dist[left] - dist[0]) / length, (dist[right] - dist[0]) / length
+
+
+def _river_stations(profiles, chainage, reach_names, reach_lengths=None):
+    """
+    River station of every profile, the distance to the downstream end of its reach as in HEC-RAS:
+    length of the reach minus chainage of the profile ID (the ID itself when chainage is not known).
+    Without the length of a reach, its most downstream profile gets station 0.
+    """
+    if chainage is None:
+        chainage = {}
+    upstream = np.array([chainage.get(profile_id, profile_id) for profile_id in profiles.ids], dtype=np.float64)
+    stations = np.empty_like(upstream)
+    for reach in set(reach_names):
+        in_reach = reach_names == reach
+        length = (reach_lengths or {}).get(reach, upstream[in_reach].max())
+        stations[in_reach] = length - upstream[in_reach]
+    return stations
+
+
+def _write_sdf_cross_sections(profiles, path, river, reach_names, stations, centerlines=None, units='METRIC'):
+    """
+    Writes cross sections in the HEC-RAS GIS import format (spatial data format, .sdf) one by one.
+    reach_names are the reaches of the profiles, centerlines map reaches to (vertices, chainage)
+    of their river line (see reach_centerline).
+    """
+    if profiles.x is None:
+        raise ValueError("HEC-RAS export needs X and Y of profile samples")
+    centerlines = centerlines or {}
+    order = np.lexsort((stations, reach_names))
+    # file without cross sections when no transect got a profile
+    extent = (profiles.x.min(), profiles.y.min(), profiles.x.max(), profiles.y.max()) if len(profiles.x) else (0, 0, 0, 0)
+    with open(path, 'w') as f:
+        f.write("BEGIN HEADER:\n"
+                f"  NUMBER OF REACHES: {len(centerlines)}\n"
+                f"  NUMBER OF CROSS-SECTIONS: {len(profiles)}\n"
+                "  BEGIN SPATIAL EXTENT:\n"
+                f"    XMIN: {extent[0]:.3f}\n    YMIN: {extent[1]:.3f}\n"
+                f"    XMAX: {extent[2]:.3f}\n    YMAX: {extent[3]:.3f}\n"
+                "  END SPATIAL EXTENT:\n"
+                f"  UNITS: {units}\n"
+                "END HEADER:\n\n")
+        if centerlines:
+            f.write("BEGIN STREAM NETWORK:\n")
+            # every reach has its own end points, reaches are not connected at confluences
+            for n, (centerline, _) in enumerate(centerlines.values()):
+                f.write(f"  ENDPOINT: {centerline[0][0]:.3f}, {centerline[0][1]:.3f}, 0, {2 * n + 1}\n"
+                        f"  ENDPOINT: {centerline[-1][0]:.3f}, {centerline[-1][1]:.3f}, 0, {2 * n + 2}\n")
+            for n, (reach, (centerline, line_chainage)) in enumerate(centerlines.items()):
+                # stations decrease downstream, the line is digitized downstream
+                line_stations = line_chainage[-1] - line_chainage
+                f.write(f"  REACH:\n    STREAM ID: {river}\n    REACH ID: {reach}\n"
+                        f"    FROM POINT: {2 * n + 1}\n    TO POINT: {2 * n + 2}\n    CENTERLINE:\n")
+                for (x, y), station in zip(centerline, line_stations):
+                    f.write(f"      {x:.3f}, {y:.3f}, 0, {station:.3f}\n")
+                f.write("  END:\n")
+            f.write("END STREAM NETWORK:\n\n")
+
+        f.write("BEGIN CROSS-SECTIONS:\n")
+        for n, i in enumerate(order):
+            start, end = profiles.offsets[i], profiles.offsets[i + 1]
+            # reach length to the next section downstream (lower station) of the same reach
+            same_reach = n > 0 and reach_names[order[n - 1]] == reach_names[i]
+            length = stations[i] - stations[order[n - 1]] if same_reach else 0.0
+            left_bank, right_bank = _bank_positions(profiles.dist[start:end], profiles.z[start:end])
+            f.write(f"  CROSS-SECTION:\n    STREAM ID: {river}\n    REACH ID: {reach_names[i]}\n"
+                    f"    STATION: {stations[i]:.2f}\n    NODE NAME: {profiles.ids[i]}\n"
+                    f"    BANK POSITIONS: {left_bank:.4f}, {right_bank:.4f}\n"
+                    f"    REACH LENGTHS: {length:.2f}, {length:.2f}, {length:.2f}\n"
+                    "    CUT LINE:\n"
+                    f"      {profiles.x[start]:.3f}, {profiles.y[start]:.3f}\n"
+                    f"      {profiles.x[end - 1]:.3f}, {profiles.y[end - 1]:.3f}\n"
+                    "    SURFACE LINE:\n")
+            f.writelines(f"      {x:.3f}, {y:.3f}, {z:.3f}\n"
+                         for x, y, z in zip(profiles.x[start:end], profiles.y[start:end], profiles.z[start:end]))
+            f.write("  END:\n")
+        f.write("END CROSS-SECTIONS:\n")
+
+
+def _write_csv_cross_sections(profiles, path, river, reach_names, stations):
+    """Writes station-elevation pairs of all cross sections to a CSV file one by one."""
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['RIVER', 'REACH', 'RIVER_STATION', 'PROFILE_ID', 'STATION', 'ELEVATION'])
+        for i, profile_id in enumerate(profiles.ids):
+            start, end = profiles.offsets[i], profiles.offsets[i + 1]
+            writer.writerows((river, reach_names[i], f'{stations[i]:.2f}', profile_id, f'{dist:.3f}', f'{z:.3f}')
+                             for dist, z in zip(profiles.dist[start:end], profiles.z[start:end]))
+
+
+def export_cross_sections(profiles, folder, river='River', reach='Reach', formats=CROSS_SECTION_FORMATS,
+                          chainage=None, centerline=None, reaches=None, centerlines=None):
+    """
+    Exports profiles as 1D model cross section geometry: cross_sections.sdf in the HEC-RAS GIS import format
+    (cut line and x, y, z surface line of every section) and cross_sections.csv with station-elevation pairs.
+    The river line is expected to be digitized downstream. River stations decrease downstream as in HEC-RAS:
+    they are the length of the reach minus the chainage of profile IDs, stations across are measured from
+    the start of the transect, which is on the left bank. Bank positions are the highest samples on both
+    sides of the thalweg. centerline (vertices of the river line) is written as the reach of the stream network.
+    For a river network, reaches map profile IDs to their reach (reach is used for the others)
+    and centerlines map reaches to their parts, the length of a reach is measured along them (see reach_centerline).
+    Sections are written one by one, nothing is collected in memory. Returns paths of written files.
+    """
+    river = re.sub(r'[,:]', '_', river)
+    # commas and colons separate values in the sdf file
+    reach_names = np.array([re.sub(r'[,:]', '_', str(reaches.get(profile_id, reach) if reaches else reach))
+                            for profile_id in profiles.ids], dtype=object)
+    if centerlines is None:
+        centerlines = {reach: [centerline]} if centerline is not None else {}
+    centerlines = {re.sub(r'[,:]', '_', str(name)): reach_centerline(parts) for name, parts in centerlines.items()}
+    # stations and the centerline come from the same parts of a reach
+    reach_lengths = {name: float(line_chainage[-1]) for name, (_, line_chainage) in centerlines.items()}
+    stations = _river_stations(profiles, chainage, reach_names, reach_lengths)
+    paths = []
+    if 'sdf' in formats:
+        paths.append(os.path.join(folder, 'cross_sections.sdf'))
+        _write_sdf_cross_sections(profiles, paths[-1], river, reach_names, stations, centerlines)
+    if 'csv' in formats:
+        paths.append(os.path.join(folder, 'cross_sections.csv'))
+        _write_csv_cross_sections(profiles, paths[-1], river, reach_names, stations)
+    return paths
+
+
+def process_pool(workers=None, initializer=None):
+    """
+    Process pool for CPU heavy stages. Inside QGIS sys.executable is the QGIS binary,
+    so worker processes are started with the Python interpreter QGIS is built with.
+    """
+    workers = workers or os.cpu_count() or 1
+    mp_context = multiprocessing.get_context('spawn')
+    if not os.path.basename(sys.executable).lower().startswith('python'):
+        for name in ('python.exe', 'pythonw.exe', os.path.join('bin', 'python3'), 'python3'):
+            candidate = os.path.join(sys.exec_prefix, name)
+            if os.path.isfile(candidate):
+                mp_context.set_executable(candidate)
+                break
+    return ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=initializer)
+
+
+DTM_NODATA = -9999.0
+# triangles longer than this are left as nodata, gaps narrower are interpolated like by the boundary footprint
+DTM_MAX_EDGE = 50.0
+
+
+def _partition_points(las_paths, tiles_folder, classes, x0, y0, tile_length, tiles_x, tiles_y, buffer, needed=None,
+                      resolution=None, progress=None):
+    """
+    Splits points into per-tile files in one pass. Every point is written to each tile whose
+    buffered extent contains it, as float32 x, y relative to the tile origin and z. The buffer must be
+    smaller than the tile.
+    needed is a boolean array of tiles to write, other tiles are skipped.
+    resolution limits the level of detail read from COPC files.
+    progress is called as progress(done, total) with points read over all files.
+    """
+    counts = np.zeros(tiles_x * tiles_y, dtype=np.int64)
+    bounds = (x0 - buffer, y0 - buffer, x0 + tiles_x * tile_length + buffer, y0 + tiles_y * tile_length + buffer)
+    # points are appended to the tile files chunk by chunk, only one chunk of the point cloud is in memory
+    for path, file_progress in _files_progress(las_paths, progress):
+        for x, y, z in iter_las_points(path, classes, bounds, resolution=resolution, progress=file_progress):
+            if len(x) == 0:
+                continue
+            tx_lo = np.clip((x - buffer - x0) // tile_length, 0, tiles_x - 1).astype(np.int64)
+            tx_hi = np.clip((x + buffer - x0) // tile_length, 0, tiles_x - 1).astype(np.int64)
+            ty_lo = np.clip((y - buffer - y0) // tile_length, 0, tiles_y - 1).astype(np.int64)
+            ty_hi = np.clip((y + buffer - y0) // tile_length, 0, tiles_y - 1).astype(np.int64)
+            # a point lies in the buffer of at most 4 tiles (buffer is smaller than tile)
+            x_split = tx_hi != tx_lo
+            y_split = ty_hi != ty_lo
+            members = [(tx_lo, ty_lo, np.ones(len(x), dtype=bool)), (tx_hi, ty_lo, x_split),
+                       (tx_lo, ty_hi, y_split), (tx_hi, ty_hi, x_split & y_split)]
+            tile_ids = np.concatenate([(ty * tiles_x + tx)[mask] for tx, ty, mask in members])
+            point_ids = np.concatenate([np.flatnonzero(mask) for _, _, mask in members])
+            if needed is not None:
+                keep = needed[tile_ids]
+                tile_ids, point_ids = tile_ids[keep], point_ids[keep]
+            order = np.argsort(tile_ids, kind='stable')
+            tile_ids, point_ids = tile_ids[order], point_ids[order]
+            unique_ids, starts = np.unique(tile_ids, return_index=True)
+            ends = np.append(starts[1:], len(tile_ids))
+            for tile_id, start, end in zip(unique_ids, starts, ends):
+                ids = point_ids[start:end]
+                tx, ty = tile_id % tiles_x, tile_id // tiles_x
+                block = np.empty((len(ids), 3), dtype=np.float32)
+                block[:, 0] = x[ids] - (x0 + tx * tile_length)
+                block[:, 1] = y[ids] - (y0 + ty * tile_length)
+                block[:, 2] = z[ids]
+                with open(os.path.join(tiles_folder, f'points_{tile_id}.bin'), 'ab') as f:
+                    block.tofile(f)
+                counts[tile_id] += len(ids)
+    return counts
+
+
+def _rasterize_tin_tile(task):
+    """Triangulates points of one tile with its buffer and rasterizes the tile core to GeoTIFF."""
+    from matplotlib.tri import Triangulation, LinearTriInterpolator
+    from osgeo import gdal
+
+    points_path, output_path, origin_x, origin_y, cols, rows, resolution, max_edge, crs_wkt = task
+    points = np.fromfile(points_path, dtype=np.float32).reshape(-1, 3).astype(np.float64)
+    values = np.full((rows, cols), DTM_NODATA, dtype=np.float32)
+    try:
+        triangulation = Triangulation(points[:, 0], points[:, 1])
+    except (RuntimeError, ValueError):
+        triangulation = None
+    if triangulation is not None:
+        # long triangles over areas without points (water, buildings) are left as nodata
+        corners_x = points[triangulation.triangles, 0]
+        corners_y = points[triangulation.triangles, 1]
+        edges = np.hypot(corners_x - np.roll(corners_x, 1, axis=1), corners_y - np.roll(corners_y, 1, axis=1))
+        triangulation.set_mask(edges.max(axis=1) > max_edge)
+        # cell centres, first row of the raster is the northern one
+        grid_x, grid_y = np.meshgrid((np.arange(cols) + 0.5) * resolution,
+                                     (rows - np.arange(rows) - 0.5) * resolution)
+        interpolated = LinearTriInterpolator(triangulation, points[:, 2])(grid_x, grid_y)
+        values = np.ma.filled(interpolated, DTM_NODATA).astype(np.float32)
+
+    # tile is written under a temporary name and renamed, runs sharing the tile cache never see a half-written tile
+    temporary_path = f'{os.path.splitext(output_path)[0]}_{os.getpid()}.tmp.tif'
+    dataset = gdal.GetDriverByName('GTiff').Create(temporary_path, cols, rows, 1, gdal.GDT_Float32, ['TILED=YES'])
+    dataset.SetGeoTransform((origin_x, resolution, 0, origin_y + rows * resolution, 0, -resolution))
+    if crs_wkt:
+        dataset.SetProjection(crs_wkt)
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(DTM_NODATA)
+    band.WriteArray(values)
+    dataset = None
+    os.replace(temporary_path, output_path)
+    return output_path
+
+
+@dataclass
+class DtmTileGrid:
+    """
+    Grid of the tiles of build_dtm_tiled over bounds of the LAS files. Tiles are aligned to multiples
+    of tile_length, raster cells to multiples of the resolution.
+    """
+    bounds: tuple
+    resolution: float
+    tile_cells: int
+    tile_length: float
+    buffer: float
+    max_edge: float
+    first_tile_x: int
+    first_tile_y: int
+    tiles_x: int
+    tiles_y: int
+
+    @classmethod
+    def create(cls, headers, resolution, tile_size=250, buffer=10, extent=None, max_edge=None):
+        bounds = (min(h.bounds[0] for h in headers), min(h.bounds[1] for h in headers),
+                  max(h.bounds[2] for h in headers), max(h.bounds[3] for h in headers))
+        if extent is not None:
+            bounds = (max(bounds[0], extent[0]), max(bounds[1], extent[1]),
+                      min(bounds[2], extent[2]), min(bounds[3], extent[3]))
+        tile_cells = max(int(round(tile_size / resolution)), 1)
+        tile_length = tile_cells * resolution
+        max_edge = max_edge or DTM_MAX_EDGE
+        buffer = max(buffer, max_edge)
+        if buffer >= tile_length:
+            raise ValueError(f"maximum triangle edge {max_edge} m must be smaller than the tile size {tile_length} m")
+        first_tile_x = math.floor(bounds[0] / tile_length)
+        first_tile_y = math.floor(bounds[1] / tile_length)
+        return cls(bounds, resolution, tile_cells, tile_length, buffer, max_edge, first_tile_x, first_tile_y,
+                   max(int(math.ceil((bounds[2] - first_tile_x * tile_length) / tile_length)), 1),
+                   max(int(math.ceil((bounds[3] - first_tile_y * tile_length) / tile_length)), 1))
+
+    @property
+    def x0(self):
+        return self.first_tile_x * self.tile_length
+
+    @property
+    def y0(self):
+        return self.first_tile_y * self.tile_length
+
+    def shared_tiles(self, headers, tile_cache_folder, classes=None, crs_wkt=None):
+        """
+        Yields (path in tile_cache_folder, LAS files around the tile) of every tile. The key of a tile is its position,
+        the DTM parameters and the LAS files within the buffer around it, identified by their resolved path,
+        size and modification time, so jobs reaching the same tiles through other paths share the rasters.
+        """
+        crs_hash = hashlib.sha256((crs_wkt or '').encode('utf-8')).hexdigest()
+        identities = {h.path: [os.path.normcase(os.path.realpath(h.path)), *StageCache.fingerprint(h.path)[1:]]
+                      for h in headers}
+        for tile_id in range(self.tiles_x * self.tiles_y):
+            tx, ty = tile_id % self.tiles_x, tile_id // self.tiles_x
+            tile_bounds = (self.x0 + tx * self.tile_length - self.buffer, self.y0 + ty * self.tile_length - self.buffer,
+                           self.x0 + (tx + 1) * self.tile_length + self.buffer,
+                           self.y0 + (ty + 1) * self.tile_length + self.buffer)
+            sources = sorted(h.path for h in headers if bounds_intersect(h.bounds, tile_bounds))
+            key = hashlib.sha256(json.dumps({
+                'tile': [self.first_tile_x + tx, self.first_tile_y + ty], 'tile_length': self.tile_length,
+                'resolution': self.resolution, 'buffer': self.buffer, 'max_edge': self.max_edge,
+                'classes': sorted(classes) if classes is not None else None, 'crs': crs_hash,
+                'sources': sorted(identities[path] for path in sources)}).encode('utf-8')).hexdigest()
+            yield os.path.join(tile_cache_folder, f'dtm_{key[:24]}.tif'), sources
+
+
+def dtm_tiles_cached(las_paths, tile_cache_folder, resolution=0.5, tile_size=250, buffer=10, classes=None,
+                     extent=None, crs_wkt=None, max_edge=None):
+    """
+    Whether every DTM tile of build_dtm_tiled with the same arguments is in tile_cache_folder,
+    then the DTM is built without reading any point. Only LAS headers are read.
+    """
+    if not tile_cache_folder or not os.path.isdir(tile_cache_folder):
+        return False
+    headers = [read_las_header(path) for path in las_paths]
+    grid = DtmTileGrid.create(headers, resolution, tile_size, buffer, extent, max_edge)
+    return all(os.path.exists(path) or not sources
+               for path, sources in grid.shared_tiles(headers, tile_cache_folder, classes, crs_wkt))
+
+
+def dtm_footprint(dtm_path, footprint_path, cell_size=2.0, close_distance=50.0, crs_wkt=None):
+    """
+    Writes the footprint of the DTM cells with data (see Footprint.write) instead of the footprint of points,
+    when the DTM comes from shared tiles and no point was read. Triangles longer than the maximum edge
+    are nodata, so the footprint follows the points like the footprint collected by filter_las.
+    """
+    from osgeo import gdal
+    dataset = gdal.Open(dtm_path)
+    transform = dataset.GetGeoTransform()
+    bounds = (transform[0], transform[3] + dataset.RasterYSize * transform[5],
+              transform[0] + dataset.RasterXSize * transform[1], transform[3])
+    footprint = Footprint(bounds, cell_size)
+    # any cell with data in a footprint cell marks it, nodata is not taken into the maximum
+    grid = gdal.Warp('', dataset, format='MEM', resampleAlg='max', srcNodata=DTM_NODATA, dstNodata=DTM_NODATA,
+                     outputBounds=(footprint.origin_x, footprint.top_y - footprint.rows * footprint.cell_size,
+                                   footprint.origin_x + footprint.cols * footprint.cell_size, footprint.top_y),
+                     width=footprint.cols, height=footprint.rows)
+    footprint.occupied = grid.GetRasterBand(1).ReadAsArray() != DTM_NODATA
+    grid = dataset = None
+    footprint.write(footprint_path, close_distance, crs_wkt)
+
+
+def build_dtm_tiled(las_paths, output_path, resolution=0.5, tile_size=250, buffer=10, classes=None,
+                    extent=None, crs_wkt=None, workers=None, max_edge=None, progress=None,
+                    tile_cache_folder=None, creation_options=None):
+    """
+    Creates a TIN DTM from classified points tile by tile in a process pool.
+    Every tile is triangulated with points from a buffer around it, so the tile rasters
+    line up without seams, and they are stitched through a VRT into one tiled GeoTIFF.
+    extent (min_x, min_y, max_x, max_y) limits the DTM, progress is called as progress(done, total)
+    after every tile, an exception raised by progress stops the run.
+    Triangles with an edge longer than max_edge metres (default DTM_MAX_EDGE) are left as nodata,
+    the buffer is at least max_edge, so triangles reaching into the neighbour tile are complete.
+
+    Tiles lie on a grid aligned to multiples of the tile size (see DtmTileGrid). With tile_cache_folder,
+    tile rasters are kept there under a key of the tile position, parameters and the LAS files around the tile,
+    so runs over overlapping survey blocks reuse each other's tiles (see dtm_tiles_cached).
+    The DTM is written as a Cloud-Optimized GeoTIFF with creation_options (see write_cog).
+    """
+    from osgeo import gdal
+
+    headers = [read_las_header(path) for path in las_paths]
+    grid = DtmTileGrid.create(headers, resolution, tile_size, buffer, extent, max_edge)
+    bounds, tile_cells, tile_length, buffer, max_edge = grid.bounds, grid.tile_cells, grid.tile_length, grid.buffer, grid.max_edge
+    x0, y0, tiles_x, tiles_y = grid.x0, grid.y0, grid.tiles_x, grid.tiles_y
+
+    tiles_folder = os.path.splitext(output_path)[0] + '_tiles'
+    os.makedirs(tiles_folder, exist_ok=True)
+    # points are appended to the tile files, leftovers of an interrupted run must go
+    for name in os.listdir(tiles_folder):
+        os.remove(os.path.join(tiles_folder, name))
+
+    tile_rasters = {}
+    needed = np.ones(tiles_x * tiles_y, dtype=bool)
+    read_paths = las_paths
+    if tile_cache_folder:
+        os.makedirs(tile_cache_folder, exist_ok=True)
+        read_paths = set()
+        for tile_id, (path, sources) in enumerate(grid.shared_tiles(headers, tile_cache_folder, classes, crs_wkt)):
+            tile_rasters[tile_id] = path
+            if os.path.exists(path) or not sources:
+                needed[tile_id] = False
+            else:
+                read_paths.update(sources)
+        read_paths = sorted(read_paths)
+    else:
+        for tile_id in range(tiles_x * tiles_y):
+            tile_rasters[tile_id] = os.path.join(tiles_folder, f'dtm_{tile_id % tiles_x}_{tile_id // tiles_x}.tif')
+
+    # points_*.bin hold a float32 copy of the points, the folder is removed also when the run fails or is canceled
+    try:
+        # reading points is the first half of the progress, rasterizing tiles the second
+        counts = _partition_points(read_paths, tiles_folder, classes, x0, y0, tile_length, tiles_x, tiles_y,
+                                   buffer, needed, resolution,
+                                   progress=None if progress is None else lambda done, total: progress(done, 2 * total))
+
+        tasks = []
+        for tile_id in np.flatnonzero(needed & (counts >= 3)):
+            tx, ty = int(tile_id % tiles_x), int(tile_id // tiles_x)
+            tasks.append((os.path.join(tiles_folder, f'points_{tile_id}.bin'), tile_rasters[tile_id],
+                          x0 + tx * tile_length, y0 + ty * tile_length,
+                          tile_cells, tile_cells, resolution, max_edge, crs_wkt))
+
+        done = 0
+        with process_pool(workers) as pool:
+            futures = [pool.submit(_rasterize_tin_tile, task) for task in tasks]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    done += 1
+                    if progress is not None:
+                        progress(len(tasks) + done, 2 * len(tasks))
+            except BaseException:
+                # progress raises to cancel the run, tiles waiting in the pool are not started
+                for future in futures:
+                    future.cancel()
+                raise
+
+        # cell aligned extent of the data, tiles on the edges are cut by the VRT
+        out_x0 = math.floor(bounds[0] / resolution) * resolution
+        out_y0 = math.floor(bounds[1] / resolution) * resolution
+        out_x1 = math.ceil(bounds[2] / resolution) * resolution
+        out_y1 = math.ceil(bounds[3] / resolution) * resolution
+        existing = sorted(path for path in tile_rasters.values() if os.path.exists(path))
+        vrt_path = os.path.join(tiles_folder, 'dtm.vrt')
+        vrt = gdal.BuildVRT(vrt_path, existing, srcNodata=DTM_NODATA, VRTNodata=DTM_NODATA,
+                            outputBounds=(out_x0, out_y0, out_x1, out_y1))
+        vrt = None
+        write_cog(vrt_path, output_path, creation_options)
+    finally:
+        shutil.rmtree(tiles_folder, ignore_errors=True)
+    return output_path
+
+
+# tiled, compressed with floating point predictor, overviews averaged without nodata cells
+COG_CREATION_OPTIONS = ['COMPRESS=DEFLATE', 'PREDICTOR=YES', 'BLOCKSIZE=512', 'OVERVIEW_RESAMPLING=AVERAGE',
+                        'BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS']
+
+
+def parse_creation_options(text):
+    """Creation options from text like 'COMPRESS=ZSTD PREDICTOR=YES' (separated by spaces, commas, semicolons or |)."""
+    return [option for option in re.split(r'[\s,;|]+', text or '') if option]
+
+
+def write_cog(source_path, output_path, creation_options=None):
+    """
+    Writes a raster as a Cloud-Optimized GeoTIFF: internally tiled, compressed and with overviews
+    (2x, 4x, ... coarser levels). creation_options of the GDAL COG driver replace the defaults
+    COG_CREATION_OPTIONS with the same name, e.g. ['COMPRESS=ZSTD', 'LEVEL=9'].
+    """
+    from osgeo import gdal
+    options = {option.split('=', 1)[0].upper(): option for option in COG_CREATION_OPTIONS}
+    for option in creation_options or []:
+        options[option.split('=', 1)[0].upper()] = option
+    result = gdal.Translate(output_path, source_path, format='COG', creationOptions=list(options.values()))
+    if result is None:
+        raise RuntimeError(f"{output_path} could not be written: {gdal.GetLastErrorMsg()}")
+    result = None
+    return output_path
+
+
+def profile_step(length, resolution, step=None, samples_per_profile=1000):
+    """
+    Sample step of a profile of the given length. A fixed step is used when it is given, otherwise
+    the profile gets samples_per_profile samples, but not closer than the DTM resolution.
+    """
+    if step is not None and step > 0:
+        return step
+    return max(resolution, length / samples_per_profile)
+
+
+def overview_level(levels, step):
+    """
+    Coarsest of levels (pixel size, band) sorted from the finest whose pixels are not larger than step.
+    A step finer than the full resolution reads the full resolution (the first level).
+    """
+    fine_enough = [level for size, level in levels if size <= step * (1 + 1e-9)]
+    return fine_enough[-1] if fine_enough else levels[0][1]
+
+
+# figure reused for all profiles rendered by one process
+_profile_figure = None
+
+
+def _init_profile_renderer():
+    """Creates the figure of a rendering process, without pyplot and its global state."""
+    global _profile_figure
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    _profile_figure = Figure(figsize=(20, 6))
+    FigureCanvasAgg(_profile_figure)
+
+
+def render_profile(task):
+    """Saves graph of one profile, task is (id_line, x_data, y_data, output_path) with numpy arrays."""
+    id_line, x_data, y_data, output_path = task
+    if _profile_figure is None:
+        _init_profile_renderer()
+    figure = _profile_figure
+    figure.clear()
+    axes = figure.add_subplot()
+
+    min_y = y_data.min()
+    y_Spacing = y_data.max() - min_y
+    if y_Spacing > 0:
+        axes.set_yticks(np.round(min_y + np.arange(11) * (y_Spacing / 10), 2))  # 10 intervals for axis Y
+
+    axes.grid(color='gray', linestyle='-', linewidth=0.1)
+
+    # style
+    axes.plot(x_data, y_data, linestyle='-', color='blue', linewidth=.5, label='graph')
+    axes.set_xlabel('distance [m]')
+    axes.set_ylabel('elevation [m]')
+    axes.set_title(f'Cross-section profile {id_line}')
+
+    figure.savefig(output_path)
+    return id_line, output_path
+
+
+def render_profiles(profiles, output_folder, workers=None, chunksize=16):
+    """
+    Renders graphs of ProfileArrays to output_folder/profile_{id_line}.png in a pool of processes,
+    yielding (id_line, output_path) as graphs are saved.
+    """
+    tasks = ((id_line, dist, z, os.path.join(output_folder, f'profile_{id_line}.png'))
+             for id_line, dist, z in profiles)
+    if workers == 1:
+        for task in tasks:
+            yield render_profile(task)
+        return
+    with process_pool(workers, initializer=_init_profile_renderer) as pool:
+        yield from pool.map(render_profile, tasks, chunksize=chunksize)
+
+
+def _max_rss(who):
+    """Lifetime maximum resident memory from getrusage (RUSAGE_SELF or RUSAGE_CHILDREN) in bytes, None without resource."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # kilobytes on Linux, bytes on macOS
+    return resource.getrusage(who).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def current_rss():
+    """
+    Resident memory of this process and all its child processes (pool workers) in bytes.
+    Without psutil only this process is measured on Linux, None elsewhere.
+    """
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        try:
+            process = psutil.Process()
+            total = process.memory_info().rss
+            for child in process.children(recursive=True):
+                try:
+                    total += child.memory_info().rss
+                except psutil.Error:
+                    # worker finished meanwhile
+                    pass
+            return total
+        except psutil.Error:
+            return None
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    return None
+
+
+class MemorySampler:
+    """
+    Samples resident memory of this process and its child processes (see current_rss) every interval
+    seconds in a background thread. peak is the highest sample, the peak of one stage, while ru_maxrss
+    is the maximum over the whole life of the process and does not include running pool workers.
+    """
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        if self.peak is not None:
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            if rss is not None:
+                self.peak = max(self.peak, rss)
+
+    def stop(self):
+        """Stops sampling and returns the peak in bytes, None when memory can not be measured."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+            rss = current_rss()
+            if rss is not None:
+                self.peak = max(self.peak, rss)
+        return self.peak
+
+
+def process_stats():
+    """
+    CPU time (of this process and finished child processes), lifetime maximum resident memory of this process
+    and of its largest finished child process (ru_maxrss, cumulative over the whole run, not per stage)
+    and bytes read and written by this process so far. Values which the platform does not provide are None.
+    """
+    times = os.times()
+    stats = {'cpu': times.user + times.system + times.children_user + times.children_system,
+             'lifetime_max_rss': None, 'lifetime_max_rss_children': None, 'read_bytes': None, 'write_bytes': None}
+    try:
+        import psutil
+        process = psutil.Process()
+        # peak working set on Windows
+        stats['lifetime_max_rss'] = getattr(process.memory_info(), 'peak_wset', None)
+        io = process.io_counters()
+        stats['read_bytes'], stats['write_bytes'] = io.read_bytes, io.write_bytes
+    except (ImportError, AttributeError, OSError):
+        pass
+    try:
+        import resource
+        stats['lifetime_max_rss'] = _max_rss(resource.RUSAGE_SELF)
+        stats['lifetime_max_rss_children'] = _max_rss(resource.RUSAGE_CHILDREN)
+    except ImportError:
+        pass
+    if stats['read_bytes'] is None and os.path.exists('/proc/self/io'):
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        stats['read_bytes'], stats['write_bytes'] = int(io['read_bytes']), int(io['write_bytes'])
+    return stats
+
+
+class RunReport:
+    """
+    Measurements of pipeline stages written to run_report.json in the output folder: wall and CPU time,
+    peak memory of the stage (sampled, see MemorySampler) and lifetime maximum memory, bytes read and written, size of outputs and counts of points and features of every stage.
+    With profile, the whole run is captured by cProfile to run_profile.prof and run_profile.txt.
+    """
+
+    FILE_NAME = 'run_report.json'
+
+    def __init__(self, folder, profile=False):
+        self.folder = folder
+        self.path = os.path.join(folder, self.FILE_NAME)
+        self.stages = []
+        self.started = time.time()
+        self.profiler = None
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    @contextmanager
+    def stage(self, name, **counts):
+        """Measures the code inside the with block as stage name, yields the record of the stage."""
+        record = {'stage': name}
+        record.update(counts)
+        before = process_stats()
+        memory = MemorySampler()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['stage_peak_rss'] = memory.stop()
+            after = process_stats()
+            record['wall'] = round(time.perf_counter() - start, 4)
+            record['cpu'] = round(after['cpu'] - before['cpu'], 4)
+            record['lifetime_max_rss'] = after['lifetime_max_rss']
+            record['lifetime_max_rss_children'] = after['lifetime_max_rss_children']
+            for key in ('read_bytes', 'write_bytes'):
+                record[key] = None if after[key] is None else after[key] - before[key]
+            self.stages.append(record)
+
+    def update(self, name, **counts):
+        """Adds counts (points, features, ...) to the last record of stage name."""
+        for record in reversed(self.stages):
+            if record['stage'] == name:
+                record.update(counts)
+                return
+
+    def write(self, **info):
+        """Writes the report, info are values of the whole run (parameters, versions, ...)."""
+        if self.profiler is not None:
+            import pstats
+            self.profiler.disable()
+            self.profiler.dump_stats(os.path.join(self.folder, 'run_profile.prof'))
+            with open(os.path.join(self.folder, 'run_profile.txt'), 'w') as f:
+                pstats.Stats(self.profiler, stream=f).sort_stats('cumulative').print_stats(50)
+            self.profiler = None
+        report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                  'python': sys.version.split()[0], 'cpu_count': os.cpu_count(), 'stages': self.stages}
+        report.update(info)
+        with open(self.path, 'w') as f:
+            json.dump(report, f, indent=1, default=str)
+        return self.path
+
+
+class StageCache:
+    """
+    Cache keys of pipeline stages stored in cross_profiles_cache.json in the output folder.
+    The key of a stage is built from size and modification time of its input files and from
+    its parameters. A stage with an unchanged key whose outputs still exist is not run again.
+    """
+
+    FILE_NAME = 'cross_profiles_cache.json'
+
+    def __init__(self, folder, enabled=True):
+        self.path = os.path.join(folder, self.FILE_NAME)
+        self.enabled = enabled
+        self.entries = {}
+        if enabled and os.path.isfile(self.path):
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                # damaged cache file, all stages are run again
+                self.entries = {}
+
+    @staticmethod
+    def fingerprint(path):
+        stat = os.stat(path)
+        return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+    def key(self, stage, inputs, params):
+        data = json.dumps({'stage': stage,
+                           'inputs': [self.fingerprint(path) for path in inputs],
+                           'params': params}, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def outputs(self, stage):
+        return self.entries.get(stage, {}).get('outputs', [])
+
+    def is_fresh(self, stage, key, outputs=None):
+        # outputs requested now (for example an optional file) must have been written by the last run
+        entry = self.entries.get(stage)
+        return (self.enabled and entry is not None and entry['key'] == key
+                and all(os.path.exists(path) for path in entry['outputs'])
+                and (outputs is None or set(outputs) <= set(entry['outputs'])))
+
+    def run(self, stage, inputs, params, outputs, function):
+        """
+        Runs function unless the stage is up to date. outputs are the files written by function,
+        when they are known only after the run (None), function returns them.
+        Returns True when the stage was run.
+        """
+        # without cache the inputs are not fingerprinted, they may be deleted after the run
+        key = self.key(stage, inputs, params) if self.enabled else None
+        if self.is_fresh(stage, key, outputs):
+            return False
+        result = function()
+        if outputs is None:
+            outputs = result
+        self.entries[stage] = {'key': key, 'outputs': list(outputs)}
+        if self.enabled:
+            with open(self.path, 'w') as f:
+                json.dump(self.entries, f, indent=1)
+        return True
+
+
+def read_line_reaches(path, reach_field=None):
+    """
+    Reads vertices of line features in a vector file grouped into reaches, returns (reaches, crs_wkt).
+    reaches maps the value of reach_field (feature ID without the field) to the parts of its features,
+    parts of a reach which continue each other are joined. Features are not dissolved across reaches.
+    """
+    from osgeo import ogr
+    dataset = ogr.Open(path)
+    if dataset is None:
+        raise ValueError(f"{path} can not be opened")
+    layer = dataset.GetLayer(0)
+    spatial_ref = layer.GetSpatialRef()
+    crs_wkt = spatial_ref.ExportToWkt() if spatial_ref is not None else None
+    if reach_field is not None and layer.GetLayerDefn().GetFieldIndex(reach_field) < 0:
+        raise ValueError(f"{path} has no field {reach_field}")
+    reaches = {}
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        geometry = geometry.Clone()
+        geometry.FlattenTo2D()
+        lines = [geometry] if geometry.GetGeometryCount() == 0 else \
+            [geometry.GetGeometryRef(i) for i in range(geometry.GetGeometryCount())]
+        reach = feature.GetField(reach_field) if reach_field is not None else feature.GetFID()
+        parts = reaches.setdefault(reach, [])
+        for line in lines:
+            if line.GetPointCount() >= 2:
+                parts.append(np.array(line.GetPoints(), dtype=np.float64))
+    dataset = None
+    return {reach: join_line_parts(parts) for reach, parts in reaches.items() if parts}, crs_wkt
+
+
+def read_line_parts(path):
+    """Reads vertices of all parts of all line features in a vector file, returns (parts, crs_wkt)."""
+    reaches, crs_wkt = read_line_reaches(path)
+    return [part for parts in reaches.values() for part in parts], crs_wkt
+
+
+def join_line_parts(parts, tolerance=1e-6):
+    """Joins line parts whose start is the end of the previous part, order of the parts is kept."""
+    joined = []
+    for vertices in parts:
+        if joined and np.hypot(*(vertices[0] - joined[-1][-1])) <= tolerance:
+            joined[-1] = np.vstack([joined[-1], vertices[1:]])
+        else:
+            joined.append(vertices)
+    return joined
+
+
+def transect_stations(vertices, spacing):
+    """
+    Walks a line by arc length and returns stations every spacing metres as arrays
+    (chainage, x, y, ux, uy, segment), where (ux, uy) is the unit tangent of the line.
+    At a vertex the tangent bisects the directions of both adjacent segments.
+    """
+    vectors = np.diff(vertices, axis=0)
+    segment_lengths = np.hypot(vectors[:, 0], vectors[:, 1])
+    valid = segment_lengths > 0
+    vertices = np.vstack([vertices[:1], vertices[1:][valid]])
+    vectors, segment_lengths = vectors[valid], segment_lengths[valid]
+    if len(segment_lengths) == 0:
+        empty = np.empty(0)
+        return empty, empty, empty, empty, empty, np.empty(0, dtype=np.int64)
+    directions = vectors / segment_lengths[:, None]
+    chainage = np.concatenate([[0.0], np.cumsum(segment_lengths)])
+
+    stations = np.arange(0.0, chainage[-1] + 1e-9, spacing)
+    segment = np.clip(np.searchsorted(chainage, stations, side='right') - 1, 0, len(segment_lengths) - 1)
+    x = np.interp(stations, chainage, vertices[:, 0])
+    y = np.interp(stations, chainage, vertices[:, 1])
+    tangent = directions[segment].copy()
+
+    # stations on inner vertices take the mean direction of the segments before and after
+    on_vertex = (np.abs(stations - chainage[segment]) < 1e-9) & (segment > 0)
+    bisector = directions[segment[on_vertex] - 1] + directions[segment[on_vertex]]
+    norm = np.hypot(bisector[:, 0], bisector[:, 1])
+    turned_back = norm < 1e-12
+    bisector[turned_back] = directions[segment[on_vertex]][turned_back]
+    norm[turned_back] = 1.0
+    tangent[on_vertex] = bisector / norm[:, None]
+    return stations, x, y, tangent[:, 0], tangent[:, 1], segment
+
+
+def create_transects(parts, width, spacing):
+    """
+    Creates transects perpendicular to line parts every spacing metres along the line,
+    reaching width metres to both sides. Returns (id, (x0, y0), (x1, y1)) as used by the samplers,
+    IDs are numbered by transect_id like TR_ID of the QGIS tool.
+    """
+    transects = []
+    for vertices in parts:
+        _, x, y, ux, uy, _ = transect_stations(vertices, spacing)
+        # left normal of the line direction
+        nx, ny = -uy, ux
+        for i in range(len(x)):
+            transects.append((transect_id(len(transects), spacing),
+                              (float(x[i] + nx[i] * width), float(y[i] + ny[i] * width)),
+                              (float(x[i] - nx[i] * width), float(y[i] - ny[i] * width))))
+    return transects
+
+
+def transect_id(index, spacing):
+    """
+    Profile ID of the index-th transect of a river network, index * spacing like TR_ID of the QGIS tool
+    (the index itself for fractional spacing). Transects are counted over the whole network.
+    """
+    return int(index * spacing) if float(spacing).is_integer() else index
+
+
+def create_reach_transects(reaches, width, spacing):
+    """
+    Creates transects of every reach separately (see create_transects), so transects of a tributary
+    do not continue the numbering and chainage of the main river. Profile IDs (see transect_id) are unique
+    over all reaches and do not depend on which reaches are processed, pass the whole network.
+    Returns (transects by reach, chainage, reach) where chainage and reach map profile IDs
+    to the distance along their reach and to the reach.
+    """
+    by_reach, chainage, reach_of = {}, {}, {}
+    index = 0
+    for reach, parts in reaches.items():
+        by_reach[reach] = []
+        # chainage goes on over the parts of a reach, gaps between them are not counted
+        start = 0.0
+        for vertices in parts:
+            stations, x, y, ux, uy, _ = transect_stations(vertices, spacing)
+            for i in range(len(x)):
+                profile_id = transect_id(index, spacing)
+                by_reach[reach].append((profile_id,
+                                        (float(x[i] - uy[i] * width), float(y[i] + ux[i] * width)),
+                                        (float(x[i] + uy[i] * width), float(y[i] - ux[i] * width))))
+                chainage[profile_id] = start + float(stations[i])
+                reach_of[profile_id] = reach
+                index += 1
+            start += float(np.hypot(*np.diff(vertices, axis=0).T).sum())
+    return by_reach, chainage, reach_of
+
+
+def sample_profiles_from_dtm(dtm_path, transects, step=None, samples_per_profile=1000, progress=None):
+    """
+    Samples elevation profiles along transects from a DTM with bilinear interpolation.
+    Only the raster window under each transect is read. Samples are taken every step metres,
+    by default every profile gets its own step (see profile_step) and is read from the coarsest
+    overview level whose pixels are not larger than the step, so wide transects do not read
+    the full resolution. Samples on nodata are left out. Returns ProfileArrays.
+    progress is called as progress(done, total) for every transect.
+    """
+    from osgeo import gdal
+    dataset = gdal.Open(dtm_path)
+    band = dataset.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    origin_x, pixel_width, _, origin_y, _, pixel_height = dataset.GetGeoTransform()
+    # (pixel size, band) of the full resolution and of the overviews from the finest
+    levels = [(abs(pixel_width), band)]
+    for i in range(band.GetOverviewCount()):
+        overview = band.GetOverview(i)
+        levels.append((abs(pixel_width) * dataset.RasterXSize / overview.XSize, overview))
+    levels.sort(key=lambda level: level[0])
+
+    ids, offsets = [], [0]
+    dist_parts, x_parts, y_parts, z_parts = [], [], [], []
+    for done, (profile_id, (x0, y0), (x1, y1)) in enumerate(transects):
+        if progress is not None:
+            progress(done, len(transects))
+        length = np.hypot(x1 - x0, y1 - y0)
+        if length == 0:
+            continue
+        profile_step_length = profile_step(length, abs(pixel_width), step, samples_per_profile)
+        level_band = overview_level(levels, profile_step_length)
+        scale_x = dataset.RasterXSize / level_band.XSize
+        scale_y = dataset.RasterYSize / level_band.YSize
+        stations = np.linspace(0.0, length, int(length // profile_step_length) + 1)
+        x = x0 + stations * (x1 - x0) / length
+        y = y0 + stations * (y1 - y0) / length
+        # pixel coordinates relative to pixel centres
+        col = (x - origin_x) / (pixel_width * scale_x) - 0.5
+        row = (y - origin_y) / (pixel_height * scale_y) - 0.5
+        col_start = max(int(np.floor(col.min())), 0)
+        row_start = max(int(np.floor(row.min())), 0)
+        col_end = min(int(np.floor(col.max())) + 2, level_band.XSize)
+        row_end = min(int(np.floor(row.max())) + 2, level_band.YSize)
+        if col_end - col_start < 2 or row_end - row_start < 2:
+            continue
+        window = level_band.ReadAsArray(col_start, row_start, col_end - col_start, row_end - row_start).astype(np.float64)
+        if nodata is not None:
+            window[window == nodata] = np.nan
+
+        col = col - col_start
+        row = row - row_start
+        inside = (col >= 0) & (row >= 0) & (col <= window.shape[1] - 1) & (row <= window.shape[0] - 1)
+        c = np.clip(np.floor(col).astype(np.int64), 0, window.shape[1] - 2)
+        r = np.clip(np.floor(row).astype(np.int64), 0, window.shape[0] - 2)
+        fc = col - c
+        fr = row - r
+        z = (window[r, c] * (1 - fc) * (1 - fr) + window[r, c + 1] * fc * (1 - fr)
+             + window[r + 1, c] * (1 - fc) * fr + window[r + 1, c + 1] * fc * fr)
+        found = inside & ~np.isnan(z)
+        if not found.any():
+            continue
+        ids.append(profile_id)
+        offsets.append(offsets[-1] + int(found.sum()))
+        dist_parts.append(stations[found])
+        x_parts.append(x[found])
+        y_parts.append(y[found])
+        z_parts.append(z[found])
+    dataset = None
+
+    def join(parts):
+        return np.concatenate(parts) if parts else np.empty(0)
+    return ProfileArrays(ids, offsets, join(dist_parts), join(z_parts), join(x_parts), join(y_parts))
+
+
+def _sample_reach(task):
+    """Samples profiles of one reach in a worker process."""
+    engine, source, transects, options = task
+    if engine == 'points':
+        return sample_profiles_from_points(source, transects, **options)
+    return sample_profiles_from_dtm(source, transects, **options)
+
+
+def sample_reach_profiles(engine, source, reach_transects, workers=None, progress=None, **options):
+    """
+    Samples profiles of every reach (transects by reach, see create_reach_transects) from the DTM (engine 'dtm',
+    source is its path) or from the points (engine 'points', source are LAS paths) and joins them.
+    Reaches are sampled in parallel processes, the points engine reads only points around each reach.
+    options are passed to sample_profiles_from_dtm or sample_profiles_from_points. progress is called
+    as progress(done, total) for every profile of a single reach, for every reach of more reaches.
+    """
+    reaches = [transects for transects in reach_transects.values() if transects]
+    if len(reaches) <= 1 or workers == 1:
+        sample = sample_profiles_from_points if engine == 'points' else sample_profiles_from_dtm
+        if len(reaches) == 1:
+            return sample(source, reaches[0], progress=progress, **options)
+        parts = []
+        for done, transects in enumerate(reaches, 1):
+            parts.append(sample(source, transects, **options))
+            if progress is not None:
+                progress(done, len(reaches))
+        return ProfileArrays.concatenate(parts)
+
+    parts = []
+    with process_pool(min(workers or os.cpu_count() or 1, len(reaches))) as pool:
+        futures = [pool.submit(_sample_reach, (engine, source, transects, options)) for transects in reaches]
+        try:
+            for future in as_completed(futures):
+                parts.append(future.result())
+                if progress is not None:
+                    progress(len(parts), len(reaches))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return ProfileArrays.concatenate(parts)
+
+
+def replace_reach_profiles(previous, profiles, reach_of, reaches):
+    """
+    Profiles after a re-run of some reaches: profiles of the other reaches are kept from previous (profiles
+    of the earlier run, None without it), those of reaches are replaced by profiles. reach_of maps profile IDs
+    to their reach, reaches are compared as text. Profiles of transects which no longer exist are dropped.
+    """
+    if previous is None:
+        return profiles
+    selected = {str(reach) for reach in reaches}
+    kept = np.array([profile_id in reach_of and str(reach_of[profile_id]) not in selected
+                     for profile_id in previous.ids], dtype=bool)
+    return ProfileArrays.concatenate([previous.subset(kept), profiles])
+
+
+def run_pipeline(las_files, line_path, output_folder, width, spacing, classes=(2, 9), engine='dtm',
+                 resolution=0.5, interpolation='idw', sample_step=0, workers=None, graphs=True,
+                 tile_cache_folder=None, samples_per_profile=1000, creation_options=None, cross_sections=(),
+                 simplify_tolerance=0, reach_field=None, reaches=None, max_edge=DTM_MAX_EDGE, log=print):
+    """
+    Runs the profile pipeline without QGIS: points -> DTM -> transects -> profile arrays -> graphs.
+    engine 'dtm' creates DTM.tif with the tiled TIN and samples it, engine 'points' samples
+    the classified points directly. The river line is not clipped by the point cloud boundary,
+    transects without points under them give no profile. Every feature of the river line is a reach
+    (features with the same value of reach_field are one reach) with its own transects and chainage,
+    reaches limits the run to the given reaches. Reaches are sampled in parallel.
+    Graphs and cross sections are drawn from profiles simplified with simplify_tolerance.
+    Returns ProfileArrays (not simplified).
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    start_time = time.time()
+    line_reaches, crs_wkt = read_line_reaches(line_path, reach_field)
+    # IDs and chainage come from the whole network, so a re-run of some reaches keeps their IDs
+    reach_transects, chainage, reach_of = create_reach_transects(line_reaches, width, spacing)
+    if reaches is not None:
+        selected = {str(reach) for reach in reaches}
+        reach_transects = {reach: transects for reach, transects in reach_transects.items() if str(reach) in selected}
+        if not reach_transects:
+            raise ValueError(f"none of the reaches {', '.join(sorted(selected))} is in {line_path}")
+    log(f"{sum(len(transects) for transects in reach_transects.values())} transects of {len(reach_transects)} reaches created")
+
+    if engine == 'points':
+        profiles = sample_reach_profiles('points', las_files, reach_transects, workers, classes=classes,
+                                         step=sample_step, interpolation=interpolation)
+    else:
+        output_DTM = os.path.join(output_folder, 'DTM.tif')
+        build_dtm_tiled(las_files, output_DTM, resolution=resolution, classes=classes, crs_wkt=crs_wkt,
+                        workers=workers, max_edge=max_edge, tile_cache_folder=tile_cache_folder, creation_options=creation_options,
+                        progress=lambda done, total: log(f"DTM {100 * done // total} %"))
+        log(f"DTM saved to {output_DTM}")
+        profiles = sample_reach_profiles('dtm', output_DTM, reach_transects, workers, step=sample_step,
+                                         samples_per_profile=samples_per_profile)
+    log(f"{len(profiles)} profiles sampled")
+
+    points_path = os.path.join(output_folder, 'profile.shp')
+    store_path = os.path.join(output_folder, 'profiles.parquet')
+    all_profiles = profiles
+    if reaches is not None:
+        # profiles of the other reaches are kept from the previous run, only the given reaches are replaced
+        if PARQUET_AVAILABLE and os.path.exists(store_path):
+            previous = read_profile_store(store_path)
+        elif os.path.exists(points_path):
+            previous = read_profile_points(points_path)
+        else:
+            previous = None
+        if previous is not None:
+            all_profiles = replace_reach_profiles(previous, profiles, reach_of, selected)
+            log(f"{len(all_profiles) - len(profiles)} profiles of other reaches kept from the previous run")
+
+    write_profile_points(all_profiles, points_path, crs_wkt)
+    if PARQUET_AVAILABLE:
+        write_profile_store(all_profiles, store_path, width, chainage, crs_wkt, reach_of)
+    if cross_sections:
+        # centerline of a reach runs over all its parts like the chainage
+        for path in export_cross_sections(all_profiles.simplify(simplify_tolerance), output_folder,
+                                          os.path.splitext(os.path.basename(line_path))[0], formats=cross_sections,
+                                          chainage=chainage, reaches=reach_of, centerlines=line_reaches):
+            log(f"Cross sections saved to {path}")
+    if graphs:
+        # graphs of the other reaches are not drawn again
+        for id_line, output_path in render_profiles(profiles.simplify(simplify_tolerance), output_folder, workers):
+            log(f"Saving profile {id_line} to {output_path}")
+    log(f"Finished in {time.time() - start_time:.1f} s")
+    return profiles
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Cross profiles from LiDAR data without QGIS.')
+    parser.add_argument('las_folder', help='folder with LAS, LAZ or COPC files')
+    parser.add_argument('line', help='vector file with river line')
+    parser.add_argument('output', help='output folder')
+    parser.add_argument('--width', type=float, required=True)
+    parser.add_argument('--spacing', type=float, required=True)
+    parser.add_argument('--classes', type=int, nargs='+', default=[2, 9])
+    parser.add_argument('--engine', choices=['dtm', 'points'], default='dtm')
+    parser.add_argument('--resolution', type=float, default=0.5)
+    parser.add_argument('--interpolation', choices=['nearest', 'idw', 'tin'], default='idw')
+    parser.add_argument('--sample-step', type=float, default=0,
+                        help='0 = native point spacing (points engine), own step of every profile (dtm engine)')
+    parser.add_argument('--samples-per-profile', type=int, default=1000)
+    parser.add_argument('--co', action='append', default=[], help='creation option of DTM COG, e.g. --co COMPRESS=ZSTD')
+    parser.add_argument('--workers', type=int, default=0, help='0 = all CPU cores')
+    parser.add_argument('--tile-cache', default=None, help='folder of DTM tiles shared between runs')
+    parser.add_argument('--no-graphs', action='store_true')
+    parser.add_argument('--simplify', type=float, default=0,
+                        help='vertical tolerance [m] of profile simplification for graphs and cross sections')
+    parser.add_argument('--cross-sections', nargs='+', choices=CROSS_SECTION_FORMATS, default=[],
+                        help='export cross sections for HEC-RAS (sdf) or as station-elevation csv')
+    parser.add_argument('--reach-field', default=None,
+                        help='field with reach ID of the river line features (default every feature is a reach)')
+    parser.add_argument('--reach', nargs='+', default=None, help='run only the given reaches')
+    parser.add_argument('--max-edge', type=float, default=DTM_MAX_EDGE,
+                        help='triangles of the DTM TIN longer than this [m] are left as nodata')
+    args = parser.parse_args(argv)
+
+    las_files = find_point_clouds(args.las_folder)
+    if not las_files:
+        parser.error(f"no LAS/LAZ files in {args.las_folder}")
+    run_pipeline(las_files, args.line, args.output, args.width, args.spacing, args.classes, args.engine,
+                 args.resolution, args.interpolation, args.sample_step, args.workers or None,
+                 not args.no_graphs, args.tile_cache, args.samples_per_profile, args.co, args.cross_sections,
+                 args.simplify, args.reach_field, args.reach, args.max_edge)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -20,18 +20,28 @@
  ***************************************************************************/
 """
 
-from qgis.PyQt.QtCore import QCoreApplication, QFileInfo
+from qgis.PyQt.QtCore import QCoreApplication, QFileInfo, QVariant
 from qgis.core import (QgsProcessing,
                        QgsProcessingAlgorithm,
                        QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterField,
                        QgsProcessingParameterString, 
                        QgsProcessingParameterVectorLayer,
                        QgsProcessingParameterFile, 
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterEnum,
                        QgsTextFormat,
                        QgsPalLayerSettings,
                        QgsVectorLayerSimpleLabeling,
                        QgsLayoutItemLabel,
                        QgsRectangle,
+                       QgsGeometry,
+                       QgsFeature,
+                       QgsField,
+                       QgsFields,
+                       QgsPointXY,
+                       QgsPoint,
                        QgsPrintLayout,
                        QgsLayoutItemMap,
                        QgsLayoutPoint,
@@ -47,15 +57,30 @@ from qgis.core import (QgsProcessing,
                        QgsLineSymbol,
                        QgsSingleSymbolRenderer,
                        QgsProcessingException, 
+                       QgsProcessingMultiStepFeedback,
                        )
 from PyQt5.QtGui import QColor
 from qgis import processing
-import matplotlib.pyplot as plt
 import geopandas as gpd
 import os
 from osgeo import gdal
 import glob
 import time
+import sys
+import hashlib
+import numpy as np
+
+#helper module cross_profiles_core.py is placed next to this script
+_script_folder = os.path.dirname(os.path.abspath(__file__))
+if _script_folder not in sys.path:
+    sys.path.append(_script_folder)
+from cross_profiles_core import (TileIndex, bounds_intersect, filter_las, filter_las_supported, las_footprint, CellMask,
+                                 write_profile_points, read_profile_points,
+                                 write_profile_store, read_profile_store, PARQUET_AVAILABLE,
+                                 export_cross_sections, CROSS_SECTION_FORMATS,
+                                 build_dtm_tiled, dtm_tiles_cached, dtm_footprint, DTM_MAX_EDGE, write_cog, parse_creation_options, render_profiles, ProfileArrays, StageCache,
+                                 transect_stations, transect_id, join_line_parts, sample_reach_profiles, replace_reach_profiles,
+                                 RunReport)
 
 
 
@@ -63,9 +88,37 @@ class CrossProfilesAlgorithm(QgsProcessingAlgorithm):
 
     INPUT_LAS_FOLDER = 'INPUT_LAS_FOLDER'
     LINE_INPUT = 'LINE_INPUT'
+    REACH_FIELD = 'REACH_FIELD'
+    REACHES = 'REACHES'
     OUTPUT_FOLDER = 'OUTPUT_FOLDER'
     Width = 'Width'
     Spacing = 'Spacing'
+    CLASSES = 'CLASSES'
+    STREAMING = 'STREAMING'
+    KEEP_INTERMEDIATE = 'KEEP_INTERMEDIATE'
+    CORRIDOR = 'CORRIDOR'
+    CORRIDOR_MARGIN = 'CORRIDOR_MARGIN'
+    PROFILE_ENGINE = 'PROFILE_ENGINE'
+    INTERPOLATION = 'INTERPOLATION'
+    SAMPLE_STEP = 'SAMPLE_STEP'
+    WRITE_PROFILE_POINTS = 'WRITE_PROFILE_POINTS'
+    CROSS_SECTION_EXPORT = 'CROSS_SECTION_EXPORT'
+    SIMPLIFY_TOLERANCE = 'SIMPLIFY_TOLERANCE'
+    DTM_METHOD = 'DTM_METHOD'
+    DTM_RESOLUTION = 'DTM_RESOLUTION'
+    DTM_CREATION_OPTIONS = 'DTM_CREATION_OPTIONS'
+    DTM_MAX_EDGE = 'DTM_MAX_EDGE'
+    WORKERS = 'WORKERS'
+    USE_CACHE = 'USE_CACHE'
+    DTM_TILE_CACHE = 'DTM_TILE_CACHE'
+    ADD_TO_PROJECT = 'ADD_TO_PROJECT'
+    PROFILE_RUN = 'PROFILE_RUN'
+
+    PROFILE_ENGINES = ['DTM raster (GDAL windowed sampling in memory)', 'Point cloud (direct sampling, no DTM)',
+                       'DTM raster (SAGA Profiles from Lines)']
+    INTERPOLATIONS = ['nearest', 'idw', 'tin']
+    #steps of the progress bar, stages which are not run are skipped
+    PROGRESS_STAGES = ['tiles', 'merge', 'filter', 'dtm', 'transects', 'profiles', 'graphs', 'cross_sections', 'preview']
 
     def initAlgorithm(self, config=None):
         self.addParameter(QgsProcessingParameterFile(
@@ -81,6 +134,22 @@ class CrossProfilesAlgorithm(QgsProcessingAlgorithm):
 
             )
         )
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.REACH_FIELD,
+                self.tr('Reach ID field of river network (empty = every line feature is a reach)'),
+                parentLayerParameterName=self.LINE_INPUT,
+                optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.REACHES,
+                self.tr('Re-run only these reaches (comma separated values of the reach ID field, empty = all reaches)'),
+                defaultValue='',
+                optional=True
+            )
+        )
         self.addParameter(
             QgsProcessingParameterString(
                 self.Width,
@@ -97,236 +166,912 @@ class CrossProfilesAlgorithm(QgsProcessingAlgorithm):
             self.OUTPUT_FOLDER,
             self.tr("Output Folder"),
             behavior=QgsProcessingParameterFile.Folder))
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.CLASSES,
+                self.tr('Classification values of terrain points (comma separated)'),
+                defaultValue='2, 9'
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.STREAMING,
+                self.tr('Streaming mode (read LAS tiles in place, no merged/filtered copies)'),
+                defaultValue=False
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.KEEP_INTERMEDIATE,
+                self.tr('Keep merged.las and filter.las in streaming mode'),
+                defaultValue=False
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.CORRIDOR,
+                self.tr('Corridor mode (read only points around the river transects)'),
+                defaultValue=False
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.CORRIDOR_MARGIN,
+                self.tr('Corridor margin [m]'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=10,
+                minValue=0
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.PROFILE_ENGINE,
+                self.tr('Profile engine'),
+                options=self.PROFILE_ENGINES,
+                defaultValue=0
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.INTERPOLATION,
+                self.tr('Interpolation of point cloud sampling'),
+                options=[self.tr('Nearest point'), self.tr('Inverse distance weighting'), self.tr('Local TIN')],
+                defaultValue=1
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.SAMPLE_STEP,
+                self.tr('Sample step of profiles [m] (0 = native point spacing or own step of every profile on DTM)'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0,
+                minValue=0
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.WRITE_PROFILE_POINTS,
+                self.tr('Write profile sample points to profile.shp'),
+                defaultValue=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.SIMPLIFY_TOLERANCE,
+                self.tr('Vertical tolerance of profile simplification for graphs and export [m] (0 = all samples)'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0,
+                minValue=0
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.CROSS_SECTION_EXPORT,
+                self.tr('Export cross sections for 1D hydraulic model'),
+                options=[self.tr('HEC-RAS GIS import format (cross_sections.sdf)'),
+                         self.tr('Station-elevation CSV (cross_sections.csv)')],
+                allowMultiple=True,
+                defaultValue=[],
+                optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.DTM_METHOD,
+                self.tr('DTM method'),
+                options=[self.tr('PDAL Export to raster (using triangulation)'),
+                         self.tr('Tiled TIN in parallel processes')],
+                defaultValue=0
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.DTM_RESOLUTION,
+                self.tr('DTM resolution [m]'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0.5,
+                minValue=0.01
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.DTM_MAX_EDGE,
+                self.tr('Maximum triangle edge of tiled TIN [m] (longer triangles are nodata)'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=DTM_MAX_EDGE,
+                minValue=0.1
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.DTM_CREATION_OPTIONS,
+                self.tr('DTM creation options of GDAL COG driver (empty = DEFLATE, predictor, 512 px tiles, overviews)'),
+                defaultValue='',
+                optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                self.tr('Number of worker processes (0 = all CPU cores)'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=0,
+                minValue=0
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.USE_CACHE,
+                self.tr('Reuse outputs of stages with unchanged inputs'),
+                defaultValue=True
+            )
+        )
+        self.addParameter(QgsProcessingParameterFile(
+            self.DTM_TILE_CACHE,
+            self.tr("Folder of DTM tiles shared between runs (tiled DTM)"),
+            behavior=QgsProcessingParameterFile.Folder,
+            optional=True))
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.ADD_TO_PROJECT,
+                self.tr('Add layers to project and export preview'),
+                defaultValue=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.PROFILE_RUN,
+                self.tr('Capture cProfile of the run to run_profile.prof'),
+                defaultValue=False
+            )
+        )
 
     def processAlgorithm(self, parameters, context, feedback):
+        #wall and CPU time, memory, I/O and counts of every stage are written to run_report.json
+        output_folder = self.parameterAsString(parameters, self.OUTPUT_FOLDER, context)
+        output_directory = QFileInfo(output_folder.rstrip("\\") + "\\").path()
+        report = RunReport(output_directory, self.parameterAsBoolean(parameters, self.PROFILE_RUN, context))
+        try:
+            with report.stage('total'):
+                return self.run_algorithm(parameters, context, feedback, report)
+        finally:
+            report_path = report.write(parameters={name: str(value) for name, value in parameters.items()})
+            feedback.pushInfo(f"Run report saved to {report_path}")
+
+    def run_algorithm(self, parameters, context, feedback, report):
+        #progress of child algorithms and of loops over tiles and profiles moves the bar within the current stage
+        feedback = QgsProcessingMultiStepFeedback(len(self.PROGRESS_STAGES), feedback)
         las_folder = self.parameterAsString(parameters, self.INPUT_LAS_FOLDER, context)
         line_path = self.parameterAsVectorLayer(parameters, self.LINE_INPUT, context)
         output_folder = self.parameterAsString(parameters, self.OUTPUT_FOLDER, context)
         Width = int(self.parameterAsString(parameters, self.Width, context))
         Spacing = int(self.parameterAsString(parameters, self.Spacing, context))
+        reach_field = self.parameterAsString(parameters, self.REACH_FIELD, context) or None
+        #profiles of the other reaches are kept from the previous run in the same output folder
+        selected_reaches = sorted({reach.strip() for reach in
+                                   (self.parameterAsString(parameters, self.REACHES, context) or '').split(',')
+                                   if reach.strip()}) or None
+        streaming = self.parameterAsBoolean(parameters, self.STREAMING, context)
+        keep_intermediate = self.parameterAsBoolean(parameters, self.KEEP_INTERMEDIATE, context)
+        corridor_mode = self.parameterAsBoolean(parameters, self.CORRIDOR, context)
+        corridor_margin = self.parameterAsDouble(parameters, self.CORRIDOR_MARGIN, context)
+        profile_engine = self.parameterAsEnum(parameters, self.PROFILE_ENGINE, context)
+        direct_sampling = profile_engine == 1
+        saga_sampling = profile_engine == 2
+        write_points = self.parameterAsBoolean(parameters, self.WRITE_PROFILE_POINTS, context) or saga_sampling
+        if selected_reaches and saga_sampling:
+            raise QgsProcessingException("SAGA Profiles from Lines samples all transects, re-running single reaches "
+                                         "needs the DTM raster (GDAL) or the point cloud profile engine.")
+        simplify_tolerance = self.parameterAsDouble(parameters, self.SIMPLIFY_TOLERANCE, context)
+        export_formats = [CROSS_SECTION_FORMATS[i] for i in self.parameterAsEnums(parameters, self.CROSS_SECTION_EXPORT, context)]
+        interpolation = self.INTERPOLATIONS[self.parameterAsEnum(parameters, self.INTERPOLATION, context)]
+        sample_step = self.parameterAsDouble(parameters, self.SAMPLE_STEP, context)
+        tiled_dtm = self.parameterAsEnum(parameters, self.DTM_METHOD, context) == 1
+        dtm_resolution = self.parameterAsDouble(parameters, self.DTM_RESOLUTION, context)
+        dtm_max_edge = self.parameterAsDouble(parameters, self.DTM_MAX_EDGE, context)
+        dtm_creation_options = parse_creation_options(self.parameterAsString(parameters, self.DTM_CREATION_OPTIONS, context))
+        workers = self.parameterAsInt(parameters, self.WORKERS, context) or os.cpu_count()
+        use_cache = self.parameterAsBoolean(parameters, self.USE_CACHE, context)
+        dtm_tile_cache = self.parameterAsString(parameters, self.DTM_TILE_CACHE, context) or None
+        add_to_project = self.parameterAsBoolean(parameters, self.ADD_TO_PROJECT, context)
+        try:
+            classes = sorted({int(value) for value in self.parameterAsString(parameters, self.CLASSES, context).split(',')
+                              if value.strip()})
+        except ValueError:
+            raise QgsProcessingException("Classification values must be integers separated by commas.")
+        if not classes or not all(0 <= c <= 255 for c in classes):
+            raise QgsProcessingException("Classification values must be between 0 and 255.")
+        filter_expression = ' OR '.join(f'Classification = {c}' for c in classes)
         
         output_folder = output_folder.rstrip("\\") + "\\"
 
-        #################################Checking CRS for inputs######################
-        ## Get the first LAS file in the LAS folder
+        def format_time(elapsed_time):
+            minutes = int(elapsed_time // 60)
+            seconds = elapsed_time % 60
+            return f"{minutes} minutes, {seconds:.2f} seconds"
         
-        las_files = glob.glob(os.path.join(las_folder, '*.las'))
-        first_las_file = las_files[0]
+        output_directory = QFileInfo(output_folder).path()
+
+        def check_canceled():
+            if feedback.isCanceled():
+                raise QgsProcessingException(self.tr("Processing was canceled."))
+
+        def start_stage(stage):
+            check_canceled()
+            feedback.setCurrentStep(self.PROGRESS_STAGES.index(stage))
+
+        def stage_progress(done, total):
+            #called for every tile or profile, cancel takes effect within one of them
+            check_canceled()
+            feedback.setProgress(100 * done / total if total else 100)
+
+        #################################Indexing LAS tiles######################
+        #LAS, LAZ and COPC (.copc.laz) tiles, PDAL reads all of them in place
+        #bounds, point count and CRS of tiles are kept in tile_index.gpkg, only new and changed tiles are scanned
+        start_stage('tiles')
+        with report.stage('tile_index') as record:
+            start_time_index = time.time()
+            index_folder = las_folder if os.access(las_folder, os.W_OK) else output_directory
+            tile_index = TileIndex(las_folder, os.path.join(index_folder, TileIndex.FILE_NAME))
+            if not tile_index.tiles:
+                raise QgsProcessingException(f"No LAS/LAZ files found in {las_folder}")
+            try:
+                tile_index.save()
+            except OSError as e:
+                feedback.pushWarning(f"Tile index could not be saved: {e}")
+            feedback.pushInfo(f"Tile index: {len(tile_index.tiles)} LAS files, {tile_index.scanned} scanned, "
+                              f"{format_time(time.time() - start_time_index)}")
+            record.update(tiles=len(tile_index.tiles), scanned=tile_index.scanned,
+                          points=sum(tile['point_count'] for tile in tile_index.tiles))
 
         ## Checking CRS for inputs ##
-        feedback.pushInfo("Checking CRS for inputs...")
-        layer1_proj = QgsPointCloudLayer(first_las_file, 'merged.las', 'pdal')
-        crs1 = layer1_proj.crs()
-        crs3 = line_path.crs()
+        with report.stage('crs_check'):
+            feedback.pushInfo("Checking CRS for inputs...")
+            crs3 = line_path.crs()
         
-        #Checking if CRS matches
-        if crs1 != crs3:
-            feedback.pushInfo("CRS do not match: Input Point Cloud CRS: {} - Line Input CRS: {}".format(crs1.authid(), crs3.authid()))
-            raise QgsProcessingException("CRS do not match between input LAS files and line input.")
+            #Checking if CRS of every tile matches
+            for crs_definition, group in tile_index.crs_groups().items():
+                if crs_definition is None:
+                    #CRS is not in the LAS headers, PDAL is asked for CRS of the first such file
+                    crs1 = QgsPointCloudLayer(tile_index.path_of(group[0]), 'merged.las', 'pdal').crs()
+                elif crs_definition.startswith('EPSG:'):
+                    crs1 = QgsCoordinateReferenceSystem(crs_definition)
+                else:
+                    crs1 = QgsCoordinateReferenceSystem.fromWkt(crs_definition)
+                names = ', '.join(tile['name'] for tile in group[:5]) + (', ...' if len(group) > 5 else '')
+                if crs1 != crs3:
+                    feedback.pushInfo("CRS do not match: Input Point Cloud CRS: {} ({} LAS files: {}) - Line Input CRS: {}".format(
+                        crs1.authid(), len(group), names, crs3.authid()))
+                    raise QgsProcessingException("CRS do not match between input LAS files and line input.")
+                else:
+                    feedback.pushInfo("CRS do match: Input Point Cloud CRS: {} ({} LAS files) - Line Input CRS: {}".format(
+                        crs1.authid(), len(group), crs3.authid()))
 
-        else:
-            feedback.pushInfo("CRS do match: Input Point Cloud CRS: {} - Line Input CRS: {}".format(crs1.authid(), crs3.authid()))
+        with report.stage('tile_selection') as record:
+            #selecting tiles reached by transects (river line buffered by Width) by bounds from the tile index
+            river_geometry = QgsGeometry.unaryUnion([f.geometry() for f in line_path.getFeatures()])
+            river_zone = river_geometry.buffer(Width, 5)
+            zone_extent = river_zone.boundingBox()
+            selected_tiles = [tile for tile in tile_index.select((zone_extent.xMinimum(), zone_extent.yMinimum(),
+                                                                 zone_extent.xMaximum(), zone_extent.yMaximum()))
+                              if river_zone.intersects(QgsGeometry.fromRect(QgsRectangle(*tile['bounds'])))]
+            feedback.pushInfo(f"{len(selected_tiles)} of {len(tile_index.tiles)} LAS files intersect the river line.")
 
-        def format_time(elapsed_time):
-            minutes = int(elapsed_time // 60)
-            seconds = int(elapsed_time % 60)
-            return f"{minutes} minutes, {seconds} seconds"
-        
-        output_directory = QFileInfo(output_folder).path()
+            #counts of points by class from the tile index, tiles without points of selected classes are not read at all
+            #counts are collected by the filter pass over the tiles, tiles not filtered yet are always read
+            class_totals = dict.fromkeys(classes, 0)
+            unknown_tiles = 0
+            matching_tiles = []
+            for tile in selected_tiles:
+                counts = tile_index.class_counts(tile)
+                if counts is None:
+                    unknown_tiles += 1
+                    matching_tiles.append(tile)
+                elif any(counts.get(c, 0) for c in classes):
+                    for c in classes:
+                        class_totals[c] += counts.get(c, 0)
+                    matching_tiles.append(tile)
+            feedback.pushInfo("Points by class: " + ', '.join(f"{c}: {n:,}" for c, n in class_totals.items())
+                              + (f" (+ {unknown_tiles} LAS files not counted yet)" if unknown_tiles else ''))
+            if len(matching_tiles) < len(selected_tiles):
+                feedback.pushInfo(f"{len(selected_tiles) - len(matching_tiles)} LAS files without points of classes "
+                                  f"{', '.join(map(str, classes))} are skipped.")
+            selected_tiles = matching_tiles
+            if not selected_tiles:
+                raise QgsProcessingException("No LAS file with points of selected classes intersects the river line.")
+            las_files = [tile_index.path_of(tile) for tile in selected_tiles]
+            all_tiles_selected = len(las_files) == len(tile_index.tiles)
+            selected_points = sum(tile['point_count'] for tile in selected_tiles)
+            record.update(tiles=len(selected_tiles), points=selected_points)
 
-        #merging point cloud
-        count_files = len(las_files)
-        if count_files > 1:
-            start_time_step1 = time.time()  # Start the timer for the processing step
-            output_file = f'{output_directory}/merged.las' 
-            feedback.pushInfo("Merging LAS files...")
-            processing.run("LAStools:LasMergePro", {
-                'INPUT_DIRECTORY': las_folder,
-                'INPUT_WILDCARDS': '*.las',
-                'FILES_ARE_FLIGHTLINES': False,
-                'APPLY_FILE_SOURCE_ID': False,
-                'OUTPUT_LASLAZ': output_file,
-                'ADDITIONAL_OPTIONS': '',
-                'VERBOSE': False,
-                'CPU64': True,
-                'GUI': False
-            })
-            elapsed_time_step1 = time.time() - start_time_step1
-            feedback.pushInfo(f"Time elapsed for merging LAS files: {format_time(elapsed_time_step1)}")
-        elif count_files == 1:
-            output_file = las_files[0] 
-            feedback.pushInfo("Only one LAS file found, skipping merging step.")    
-
-        start_time_filter = time.time()  # Start the timer for the filtering step
-        output_filter = f'{output_directory}/filter.las'
-        feedback.pushInfo("Filtering LAS files...")
-        processing.run("pdal:filter", {
-            'INPUT': output_file,
-            'FILTER_EXPRESSION':'Classification = 2 OR Classification = 9',
-            'FILTER_EXTENT': None,
-            'OUTPUT': output_filter
-        })
-        elapsed_time_filter = time.time() - start_time_filter
-        feedback.pushInfo(f"Time elapsed for filtering LAS files: {format_time(elapsed_time_filter)}")
-                    
+        def report_throughput(stage_ran, elapsed_time):
+            #points/s of a stage which reads all points of the selected tiles
+            if stage_ran and elapsed_time > 0:
+                feedback.pushInfo(f"{selected_points:,} points read at {selected_points / elapsed_time:,.0f} points/s")
+
+        #stages with unchanged inputs and parameters reuse their outputs from the previous run
+        cache = StageCache(output_directory, use_cache)
+
+        def remove_outputs(outputs):
+            for path in outputs or []:
+                if path.endswith('.shp'):
+                    paths = [os.path.splitext(path)[0] + extension
+                             for extension in ('.shp', '.shx', '.dbf', '.prj', '.cpg', '.qpj')]
+                else:
+                    paths = [path]
+                for output in paths:
+                    if os.path.exists(output):
+                        os.remove(output)
+
+        def run_stage(stage, inputs, params, outputs, function, **counts):
+            #counts are points or features handled by the stage, written to the run report
+            with report.stage(stage, **counts) as record:
+                try:
+                    ran = cache.run(stage, inputs, params, outputs, function)
+                except BaseException:
+                    #outputs of a canceled stage are incomplete, they are not left in the output folder
+                    if feedback.isCanceled():
+                        remove_outputs(outputs)
+                    raise
+                record['reused'] = not ran
+                record['output_bytes'] = sum(os.path.getsize(path) for path in cache.outputs(stage)
+                                             if os.path.isfile(path))
+            if not ran:
+                reused = ', '.join(os.path.basename(path) for path in cache.outputs(stage)[:3])
+                feedback.pushInfo(f"Inputs of stage {stage} did not change, reusing {reused}")
+                return False
+            return True
+
+        line_key = self.line_fingerprint(line_path, reach_field)
+
+        output_DTM = f'{output_directory}/DTM.tif'
         #Boundary of Point Cloud for cliping river and DTM
         boundary = f'{output_directory}/extracted_boundary.shp'
-          
-        processing.run("LAStools:LasBoundary", 
-                       {'VERBOSE':False,'CPU64':False,'GUI':False,
-                        'INPUT_LASLAZ':output_filter,
-                        'FILTER_RETURN_CLASS_FLAGS1':0,'MODE':0,'CONCAVITY':50,'HOLES':True,'DISJOINT':True,
-                        'LABELS':False,'OUTPUT_VECTOR':boundary,'ADDITIONAL_OPTIONS':''})
+        dtm_extent = None
+        #boundary is a footprint of points on a grid of cell_size metres, gaps narrower than close_distance
+        #(river surface without ground points) are closed like with concavity 50 of LasBoundary
+        footprint_params = {'cell_size': 2.0, 'close_distance': 50.0}
+
+        def build_virtual_point_cloud(point_cloud, las_files):
+            run_stage('vpc', las_files, {}, [point_cloud],
+                      lambda: processing.run("pdal:virtualpointcloud", {
+                          'LAYERS': las_files,
+                          'BOUNDARY': False,
+                          'STATISTICS': False,
+                          'OVERVIEW': False,
+                          'OUTPUT': point_cloud
+                      }, context=context, feedback=feedback))
+
+        def filter_tiles(output_filter, corridor=None):
+            #points of selected classes are written, their footprint (boundary) and counts by class of every LAS file
+            #are collected in one pass over the LAS tiles, so the points are not read again by LasBoundary or PDAL
+            start_time_filter = time.time()
+            tile_histogram = np.zeros((len(las_files), 256), dtype=np.int64)
+            outputs = [output_filter, boundary] if output_filter else [boundary]
+            filter_ran = run_stage('filter', las_files + ([corridor] if corridor else []),
+                                   {'classes': classes, 'footprint': footprint_params, 'corridor': bool(corridor)}, outputs,
+                                   lambda: filter_las(las_files, output_filter, classes, boundary, crs_wkt=crs3.toWkt(),
+                                                      **footprint_params, histogram=tile_histogram,
+                                                      region=CellMask.from_polygons(corridor, footprint_params['cell_size'])
+                                                      if corridor else None,
+                                                      progress=stage_progress),
+                                   points=selected_points)
+            elapsed_time_filter = time.time() - start_time_filter
+            feedback.pushInfo(f"Time elapsed for filtering LAS files: {format_time(elapsed_time_filter)}")
+            if filter_ran:
+                #counts by class are kept in the tile index, later runs skip LAS files without selected classes
+                for tile, counts in zip(selected_tiles, tile_histogram):
+                    tile_index.set_class_counts(tile, counts)
+                try:
+                    tile_index.save()
+                except OSError as e:
+                    feedback.pushWarning(f"Tile index could not be saved: {e}")
+                totals = tile_histogram.sum(axis=0)
+                feedback.pushInfo("Points by class: " + ', '.join(f"{c}: {totals[c]:,}" for c in np.flatnonzero(totals)))
+            report_throughput(filter_ran, elapsed_time_filter)
+
+        #LAZ files need laspy, tiles of different point formats are merged by PDAL first
+        direct_filter = filter_las_supported(las_files)
+        if not direct_filter:
+            feedback.pushInfo("LAS files are filtered by PDAL (LAZ files without laspy or different point formats), "
+                              "counts of points by class are not collected.")
+
+        def build_tiled_dtm(dtm_files):
+            start_time_DTM = time.time()
+            
+            feedback.pushInfo(f"Creating DTM in tiles with {workers} processes...")
+            run_stage('dtm', dtm_files, {'method': 'tiled', 'resolution': dtm_resolution, 'cog': dtm_creation_options,
+                                          'max_edge': dtm_max_edge,
+                                          'classes': classes,
+                                          'extent': None if dtm_extent is None else dtm_extent.toString()},
+                      [output_DTM],
+                      lambda: build_dtm_tiled(dtm_files, output_DTM, resolution=dtm_resolution, tile_size=250, buffer=10, classes=classes,
+                                              extent=None if dtm_extent is None else (dtm_extent.xMinimum(), dtm_extent.yMinimum(),
+                                                                                      dtm_extent.xMaximum(), dtm_extent.yMaximum()),
+                                              crs_wkt=crs1.toWkt(), workers=workers, max_edge=dtm_max_edge,
+                                              progress=stage_progress,
+                                              tile_cache_folder=dtm_tile_cache, creation_options=dtm_creation_options),
+                      points=selected_points)
+                    
+            elapsed_time_DTM = time.time() - start_time_DTM
+            feedback.pushInfo(f"Time elapsed for creating DTM: {format_time(elapsed_time_DTM)}")
+
+        #with shared DTM tiles, a job whose tiles were all built by an overlapping job reads no point at all:
+        #merge and filter are skipped and the boundary is the footprint of the DTM
+        dtm_cached = (tiled_dtm and not direct_sampling and not corridor_mode and not (streaming and keep_intermediate)
+                      and dtm_tiles_cached(las_files, dtm_tile_cache, resolution=dtm_resolution, tile_size=250, buffer=10,
+                                           classes=classes, crs_wkt=crs1.toWkt(), max_edge=dtm_max_edge))
+
+        start_stage('merge')
+        if dtm_cached:
+            feedback.pushInfo("All DTM tiles of the LAS files are in the shared tile cache, merging and filtering are skipped.")
+            start_stage('dtm')
+            build_tiled_dtm(las_files)
+            run_stage('boundary', [output_DTM], {'method': 'dtm', 'footprint': footprint_params}, [boundary],
+                      lambda: dtm_footprint(output_DTM, boundary, crs_wkt=crs3.toWkt(), **footprint_params))
+            dtm_input = None
+            dtm_filter_expression = ''
+        elif corridor_mode:
+            #corridor - union of the transect footprints plus margin, computed before any point processing
+            start_time_corridor = time.time()
+            feedback.pushInfo("Creating river corridor...")
+            corridor = f'{output_directory}/corridor.shp'
+            run_stage('corridor', [], {'line': line_key, 'width': Width, 'spacing': Spacing, 'margin': corridor_margin,
+                                      'reach_field': reach_field},
+                      [corridor],
+                      lambda: processing.run("native:buffer",
+                                             {'INPUT': self.create_transects(line_path, Width, Spacing, context=context,
+                                                                             feedback=feedback, reach_field=reach_field),
+                                              'DISTANCE': corridor_margin,
+                                              'SEGMENTS': 5, 'END_CAP_STYLE': 0, 'JOIN_STYLE': 0, 'MITER_LIMIT': 2,
+                                              'DISSOLVE': True,
+                                              'OUTPUT': corridor}, context=context, feedback=feedback))
+            corridor_layer = QgsVectorLayer(corridor, 'corridor', 'ogr')
+            corridor_geometry = QgsGeometry.unaryUnion([f.geometry() for f in corridor_layer.getFeatures()])
+            dtm_extent = corridor_layer.extent()
+            del corridor_layer
+
+            #selecting tiles by bounds from LAS headers, points are not read
+            corridor_bounds = (dtm_extent.xMinimum(), dtm_extent.yMinimum(),
+                               dtm_extent.xMaximum(), dtm_extent.yMaximum())
+            selected_tiles = [tile for tile in selected_tiles
+                              if bounds_intersect(tile['bounds'], corridor_bounds)
+                              and corridor_geometry.intersects(QgsGeometry.fromRect(QgsRectangle(*tile['bounds'])))]
+            corridor_files = [tile_index.path_of(tile) for tile in selected_tiles]
+            selected_points = sum(tile['point_count'] for tile in selected_tiles)
+            feedback.pushInfo(f"{len(corridor_files)} of {len(las_files)} LAS files intersect the river corridor.")
+            if not corridor_files:
+                raise QgsProcessingException("No LAS file intersects the river corridor.")
+            las_files = corridor_files
+
+            #only classified points inside the corridor are written
+            if streaming:
+                output_filter = f'{output_directory}/corridor.las'
+            else:
+                output_filter = f'{output_directory}/filter.las'
+            start_stage('filter')
+            feedback.pushInfo("Clipping and filtering LAS files by river corridor...")
+            if direct_filter:
+                #corridor is tested on a grid of footprint cells while the tiles are read
+                filter_tiles(output_filter, corridor)
+            else:
+                point_cloud = f'{output_directory}/tiles.vpc'
+                build_virtual_point_cloud(point_cloud, las_files)
+                clip_ran = run_stage('corridor_clip', las_files + [corridor], {'expression': filter_expression}, [output_filter],
+                                     lambda: processing.run("pdal:clip", {
+                                         'INPUT': point_cloud,
+                                         'OVERLAY': corridor,
+                                         'FILTER_EXPRESSION': filter_expression,
+                                         'FILTER_EXTENT': None,
+                                         'OUTPUT': output_filter
+                                     }, context=context, feedback=feedback), points=selected_points)
+                elapsed_time_corridor = time.time() - start_time_corridor
+                feedback.pushInfo(f"Time elapsed for corridor clipping: {format_time(elapsed_time_corridor)}")
+                report_throughput(clip_ran, elapsed_time_corridor)
+                run_stage('boundary', [output_filter], {'method': 'footprint', 'footprint': footprint_params}, [boundary],
+                          lambda: las_footprint([output_filter], boundary, crs_wkt=crs3.toWkt(), **footprint_params,
+                                                progress=stage_progress))
+            dtm_input = output_filter
+            dtm_filter_expression = ''
+        elif streaming:
+            #virtual point cloud - tiles are read in place by PDAL, merged.las and filter.las are not written
+            start_time_step1 = time.time()
+            point_cloud = f'{output_directory}/tiles.vpc'
+            feedback.pushInfo("Building virtual point cloud from LAS tiles...")
+            build_virtual_point_cloud(point_cloud, las_files)
+            elapsed_time_step1 = time.time() - start_time_step1
+            feedback.pushInfo(f"Time elapsed for building virtual point cloud: {format_time(elapsed_time_step1)}")
+
+            if keep_intermediate:
+                feedback.pushInfo("Writing merged LAS file...")
+                run_stage('merge', las_files, {'method': 'pdal'}, [f'{output_directory}/merged.las'],
+                          lambda: processing.run("pdal:merge", {
+                              'LAYERS': las_files,
+                              'FILTER_EXPRESSION': '',
+                              'FILTER_EXTENT': None,
+                              'OUTPUT': f'{output_directory}/merged.las'
+                          }, context=context, feedback=feedback))
+
+            start_stage('filter')
+            if direct_filter:
+                #boundary and counts by class are collected while the tiles are read, filter.las is written only when kept
+                filter_tiles(f'{output_directory}/filter.las' if keep_intermediate else None)
+            else:
+                if keep_intermediate:
+                    run_stage('filter', las_files, {'expression': filter_expression}, [f'{output_directory}/filter.las'],
+                              lambda: processing.run("pdal:filter", {
+                                  'INPUT': point_cloud,
+                                  'FILTER_EXPRESSION': filter_expression,
+                                  'FILTER_EXTENT': None,
+                                  'OUTPUT': f'{output_directory}/filter.las'
+                              }, context=context, feedback=feedback))
+                #classification filter is applied while the tiles are streamed
+                start_time_boundary = time.time()
+                boundary_ran = run_stage('boundary', las_files, {'method': 'pdal', 'expression': filter_expression}, [boundary],
+                                         lambda: processing.run("pdal:boundary",
+                                                                {'INPUT': point_cloud,
+                                                                 'RESOLUTION': None,
+                                                                 'THRESHOLD': None,
+                                                                 'FILTER_EXPRESSION': filter_expression,
+                                                                 'FILTER_EXTENT': None,
+                                                                 'OUTPUT': boundary},
+                                                                context=context, feedback=feedback), points=selected_points)
+                report_throughput(boundary_ran, time.time() - start_time_boundary)
+            dtm_input = point_cloud
+            dtm_filter_expression = filter_expression
+        else:
+            #merging point cloud
+            count_files = len(las_files)
+            if count_files > 1:
+                start_time_step1 = time.time()  # Start the timer for the processing step
+                output_file = f'{output_directory}/merged.las' 
+                feedback.pushInfo("Merging LAS files...")
+                if not all_tiles_selected:
+                    #LasMergePro merges the whole folder, the selected tiles are merged by PDAL
+                    run_stage('merge', las_files, {'method': 'pdal'}, [output_file],
+                              lambda: processing.run("pdal:merge", {
+                                  'LAYERS': las_files,
+                                  'FILTER_EXPRESSION': '',
+                                  'FILTER_EXTENT': None,
+                                  'OUTPUT': output_file
+                              }, context=context, feedback=feedback), points=selected_points)
+                else:
+                    run_stage('merge', las_files, {'method': 'lastools'}, [output_file],
+                              lambda: processing.run("LAStools:LasMergePro", {
+                                  'INPUT_DIRECTORY': las_folder,
+                                  'INPUT_WILDCARDS': '*.las *.laz',
+                                  'FILES_ARE_FLIGHTLINES': False,
+                                  'APPLY_FILE_SOURCE_ID': False,
+                                  'OUTPUT_LASLAZ': output_file,
+                                  'ADDITIONAL_OPTIONS': '',
+                                  'VERBOSE': False,
+                                  'CPU64': True,
+                                  'GUI': False
+                              }, context=context, feedback=feedback), points=selected_points)
+                elapsed_time_step1 = time.time() - start_time_step1
+                feedback.pushInfo(f"Time elapsed for merging LAS files: {format_time(elapsed_time_step1)}")
+            elif count_files == 1:
+                output_file = las_files[0] 
+                feedback.pushInfo("Only one LAS file found, skipping merging step.")    
+
+            start_stage('filter')
+            output_filter = f'{output_directory}/filter.las'
+            feedback.pushInfo("Filtering LAS files and extracting boundary...")
+            if direct_filter:
+                #tiles are filtered directly, merged.las is not read again
+                filter_tiles(output_filter)
+            else:
+                start_time_filter = time.time()  # Start the timer for the filtering step
+                filter_ran = run_stage('filter', [output_file], {'expression': filter_expression}, [output_filter],
+                                       lambda: processing.run("pdal:filter", {
+                                           'INPUT': output_file,
+                                           'FILTER_EXPRESSION': filter_expression,
+                                           'FILTER_EXTENT': None,
+                                           'OUTPUT': output_filter
+                                       }, context=context, feedback=feedback), points=selected_points)
+                run_stage('boundary', [output_filter], {'method': 'footprint', 'footprint': footprint_params}, [boundary],
+                          lambda: las_footprint([output_filter], boundary, crs_wkt=crs3.toWkt(), **footprint_params,
+                                                progress=stage_progress))
+                elapsed_time_filter = time.time() - start_time_filter
+                feedback.pushInfo(f"Time elapsed for filtering LAS files: {format_time(elapsed_time_filter)}")
+                report_throughput(filter_ran, elapsed_time_filter)
+            dtm_input = output_filter
+            dtm_filter_expression = ''
         
         #Assingnig projection for vector layer
         processing.run("qgis:definecurrentprojection", 
                        {'INPUT':boundary,
                         'CRS':QgsCoordinateReferenceSystem(crs1)
-                        })
+                        }, context=context, feedback=feedback)
                         
-        start_time_DTM = time.time()
-        
-        output_DTM = f'{output_directory}/DTM.tif'
-        feedback.pushInfo("Creating DTM ...")
-        processing.run("pdal:exportrastertin", 
-        {'INPUT':output_filter,'RESOLUTION':0.5,'TILE_SIZE':1000,'FILTER_EXPRESSION':'','FILTER_EXTENT':None,'ORIGIN_X':None,
-        'ORIGIN_Y':None,'OUTPUT':output_DTM})
-                
-        elapsed_time_DTM = time.time() - start_time_DTM  # Measure elapsed time for step 1
-        feedback.pushInfo(f"Time elapsed for creating DTM: {format_time(elapsed_time_DTM)}")
+        #LAS files read directly by the point cloud engine and the tiled DTM
+        point_files = las_files if dtm_input is None or dtm_input.endswith('.vpc') else [dtm_input]
+        #shared DTM tiles are keyed by the LAS tiles of the survey block, filter.las of this run would never match
+        dtm_files = las_files if dtm_tile_cache else point_files
+
+        start_stage('dtm')
+        if direct_sampling:
+            #profiles are sampled from the points, DTM is not created
+            feedback.pushInfo("Point cloud profile engine selected, skipping DTM.")
+        elif dtm_cached:
+            #built from the shared tile cache before merging
+            pass
+        elif tiled_dtm:
+            build_tiled_dtm(dtm_files)
+        else:
+            start_time_DTM = time.time()
+            
+            feedback.pushInfo("Creating DTM ...")
+
+            def export_dtm():
+                tin_DTM = f'{output_directory}/DTM_tin.tif'
+                processing.run("pdal:exportrastertin", 
+                {'INPUT':dtm_input,'RESOLUTION':dtm_resolution,'TILE_SIZE':1000,'FILTER_EXPRESSION':dtm_filter_expression,'FILTER_EXTENT':dtm_extent,'ORIGIN_X':None,
+                'ORIGIN_Y':None,'OUTPUT':tin_DTM}, context=context, feedback=feedback)
+                #tiled and compressed COG with overviews for sampling of wide profiles and for map canvas
+                write_cog(tin_DTM, output_DTM, dtm_creation_options)
+                os.remove(tin_DTM)
+
+            run_stage('dtm', point_files, {'method': 'pdal', 'resolution': dtm_resolution, 'cog': dtm_creation_options,
+                                          'expression': dtm_filter_expression,
+                                          'extent': None if dtm_extent is None else dtm_extent.toString()},
+                      [output_DTM], export_dtm, points=selected_points)
+                    
+            elapsed_time_DTM = time.time() - start_time_DTM  # Measure elapsed time for step 1
+            feedback.pushInfo(f"Time elapsed for creating DTM: {format_time(elapsed_time_DTM)}")
 
                                
     #################################################### Line (river) editing#################################################
+        start_stage('transects')
         start_time_profiles = time.time()
         
-        #Clip river by las boundary
-        step_1 = processing.run("native:clip",
-                       {'INPUT':line_path,
-                        'OVERLAY':boundary,
-                        'OUTPUT':'TEMPORARY_OUTPUT'})
-        
-        result1 = processing.run("native:dissolve",
-                                 {'INPUT': step_1['OUTPUT'],
-                                  'FIELD': [],
-                                  'SEPARATE_DISJOINT': False,
-                                  'OUTPUT': 'TEMPORARY_OUTPUT'})
-                                         
-        result2 = processing.run("native:densifygeometriesgivenaninterval",
-                                 {'INPUT': result1['OUTPUT'],
-                                  'INTERVAL': 1, 'OUTPUT': 'TEMPORARY_OUTPUT'})
-
-        #Creating transect (lines of profiles)
-        result3 = processing.run("native:transect",
-                                 {'INPUT': result2['OUTPUT'],
-                                  'LENGTH': Width, 'ANGLE': 90, 'SIDE': 2,
-                                  'OUTPUT': 'TEMPORARY_OUTPUT'})
-                
-        #Extraction of profiles selected by user based on expression
-        expr = f'"TR_ID" % {Spacing} = 0'
-
-        result4 = processing.run("native:extractbyexpression",
-                                 {'INPUT': result3['OUTPUT'],
-                                  'EXPRESSION': expr,
-                                  'OUTPUT': 'TEMPORARY_OUTPUT'})
+        output_transects = f'{output_directory}/transects.gpkg'
+        run_stage('transects', [boundary], {'line': line_key, 'width': Width, 'spacing': Spacing, 'reach_field': reach_field},
+                  [output_transects],
+                  lambda: self.create_transects(line_path, Width, Spacing, boundary, output_transects, context, feedback,
+                                                reach_field))
+        transects = QgsVectorLayer(output_transects, 'transects', 'ogr')
+        report.update('transects', features=transects.featureCount())
         
         output_profile = f'{output_directory}/profile.shp'
         output_profiles = f'{output_directory}/profiles.shp'
+        #columnar store of profile samples for hydraulic modelling, one row group per profile
+        output_store = f'{output_directory}/profiles.parquet'
+        if not PARQUET_AVAILABLE:
+            feedback.pushInfo("pyarrow is not installed, profiles.parquet is not written.")
+        #every reach of the river network has its own chainage, TR_ID is unique over the whole network
+        chainage = {feature['TR_ID']: feature['TR_CHAINAGE'] for feature in transects.getFeatures()}
+        reaches = {feature['TR_ID']: feature['TR_REACH'] for feature in transects.getFeatures()}
+        if selected_reaches:
+            missing = set(selected_reaches) - {str(reach) for reach in reaches.values()}
+            if missing:
+                raise QgsProcessingException(f"Reaches {', '.join(sorted(missing))} have no transects inside the point cloud boundary.")
+            feedback.pushInfo(f"Re-running reaches {', '.join(selected_reaches)}, profiles of the other reaches are kept.")
+        profiles = None
         
         #creating profile lines
-        result5 = processing.run("sagang:profilesfromlines",
-                                 {'DEM': output_DTM,
-                                  'VALUES': None,
-                                  'LINES': result4['OUTPUT'],  
-                                  'NAME': 'ID',
-                                  'PROFILE': output_profile,
-                                  'PROFILES': output_profiles, 'SPLIT': False})
+        start_stage('profiles')
+        if not saga_sampling:
+            #profiles are sampled into arrays in memory, profile.shp is only an optional copy of them
+            if direct_sampling:
+                profile_inputs = point_files + [output_transects]
+                profile_params = {'engine': 'points', 'classes': classes, 'step': sample_step, 'interpolation': interpolation}
+            else:
+                profile_inputs = [output_DTM, output_transects]
+                profile_params = {'engine': 'gdal', 'step': sample_step}
+            profile_params['reaches'] = selected_reaches
+
+            def read_previous_profiles():
+                if PARQUET_AVAILABLE and os.path.exists(output_store):
+                    return read_profile_store(output_store)
+                if os.path.exists(output_profile):
+                    return read_profile_points(output_profile)
+                feedback.pushWarning("No profiles of a previous run found, only the selected reaches will have profiles.")
+                return None
+
+            def sample_profiles():
+                nonlocal profiles
+                #reaches are sampled in parallel processes
+                reach_transects = {}
+                for feature in transects.getFeatures():
+                    if selected_reaches and str(feature['TR_REACH']) not in selected_reaches:
+                        continue
+                    vertices = list(feature.geometry().vertices())
+                    reach_transects.setdefault(feature['TR_REACH'], []).append(
+                        (feature['TR_ID'], (vertices[0].x(), vertices[0].y()), (vertices[-1].x(), vertices[-1].y())))
+                if direct_sampling:
+                    feedback.pushInfo(f"Sampling profiles of {len(reach_transects)} reaches from point cloud ({interpolation})...")
+                    profiles = sample_reach_profiles('points', point_files, reach_transects, workers, stage_progress,
+                                                     classes=classes, step=sample_step, interpolation=interpolation)
+                else:
+                    #only DTM windows under the transects are read, bilinear interpolation in numpy
+                    feedback.pushInfo(f"Sampling profiles of {len(reach_transects)} reaches from DTM...")
+                    profiles = sample_reach_profiles('dtm', output_DTM, reach_transects, workers, stage_progress,
+                                                     step=sample_step)
+                if selected_reaches:
+                    #profiles of the previous run are read before profile.shp and profiles.parquet are replaced
+                    sampled = len(profiles)
+                    profiles = replace_reach_profiles(read_previous_profiles(), profiles, reaches, selected_reaches)
+                    feedback.pushInfo(f"{len(profiles) - sampled} profiles of other reaches kept from the previous run")
+                if write_points:
+                    write_profile_points(profiles, output_profile, crs1.toWkt())
+                if PARQUET_AVAILABLE:
+                    write_profile_store(profiles, output_store, Width, chainage, crs1.toWkt(), reaches)
+
+            profile_outputs = ([output_profile] if write_points else []) + ([output_store] if PARQUET_AVAILABLE else [])
+            if profile_outputs:
+                run_stage('profiles', profile_inputs, profile_params, profile_outputs, sample_profiles,
+                          points=selected_points if direct_sampling else None)
+            else:
+                with report.stage('profiles', points=selected_points if direct_sampling else None):
+                    sample_profiles()
+            if profiles is not None:
+                report.update('profiles', features=len(profiles), samples=len(profiles.z))
+            field_name = 'ID'
+        else:
+            profile_inputs = [output_DTM, output_transects]
+            profile_params = {'engine': 'saga'}
+            run_stage('profiles', profile_inputs, profile_params, [output_profile, output_profiles],
+                      lambda: processing.run("sagang:profilesfromlines",
+                                             {'DEM': output_DTM,
+                                              'VALUES': None,
+                                              'LINES': transects,  
+                                              'NAME': 'ID',
+                                              'PROFILE': output_profile,
+                                              'PROFILES': output_profiles, 'SPLIT': False},
+                                             context=context, feedback=feedback))
         
-        attribute_layer = QgsVectorLayer(output_profile, "profile", "ogr")
-        fields = attribute_layer.fields()
-        field_name = fields[0].name()
+            attribute_layer = QgsVectorLayer(output_profile, "profile", "ogr")
+            fields = attribute_layer.fields()
+            field_name = fields[0].name()
+
+            def read_saga_profiles():
+                gdf = gpd.read_file(output_profile, ignore_geometry=True)
+                #distance field name differs between SAGA versions
+                if 'DIST' in gdf.columns:
+                    distance_field = 'DIST'
+                elif 'DISTANCE' in gdf.columns:
+                    distance_field = 'DISTANCE'
+                else:
+                    raise QgsProcessingException(f"{output_profile} was not correctly generated")
+                saga_profiles = ProfileArrays.from_columns(gdf[field_name].to_numpy(),
+                                                           gdf[distance_field].to_numpy(),
+                                                           gdf['Z'].to_numpy(),
+                                                           gdf['X'].to_numpy() if 'X' in gdf.columns else None,
+                                                           gdf['Y'].to_numpy() if 'Y' in gdf.columns else None)
+                #SAGA numbers profiles by the order of transects, chainage and reaches are keyed by TR_ID
+                return self.saga_profiles_by_transect(transects, saga_profiles)
+
+            if PARQUET_AVAILABLE:
+                def convert_saga_profiles():
+                    nonlocal profiles
+                    profiles = read_saga_profiles()
+                    write_profile_store(profiles, output_store, Width, chainage, crs1.toWkt(), reaches)
+
+                run_stage('profile_store', [output_profile, output_transects], {'width': Width}, [output_store],
+                          convert_saga_profiles)
       
       
-        output_Profile_layer = os.path.join(output_directory, 'Profile_layer.shp')
+        def load_profiles():
+            nonlocal profiles
+            if profiles is None:
+                #profiles of a previous run are read from the columnar store, or from profile.shp
+                if os.path.exists(output_store) and PARQUET_AVAILABLE:
+                    profiles = read_profile_store(output_store)
+                elif saga_sampling:
+                    profiles = read_saga_profiles()
+                else:
+                    profiles = read_profile_points(output_profile)
+            return profiles
 
         # Spustenie nástroja na vytvorenie vrstvy
-        result6 = processing.run("native:joinattributesbylocation",
-                                 {'INPUT': result4['OUTPUT'], 'PREDICATE': [0],
-                                  'JOIN': output_profile,
-                                  'JOIN_FIELDS': field_name, 'METHOD': 1,
-                                  'DISCARD_NONMATCHING': True, 'PREFIX': '', 'OUTPUT':'TEMPORARY_OUTPUT'})
-        profile_layer = result6['OUTPUT']
+        #transects with a profile are found by their ID, profile samples are not joined by location
+        if add_to_project:
+            with report.stage('profile_layer') as record:
+                profile_layer = self.create_profile_layer(transects, load_profiles())
+                field_name = 'ID'
+                record['features'] = profile_layer.featureCount()
 
   
-        #deleting temporary (unnecessary) files
-        files_to_remove = []
-        files_to_remove.extend(glob.glob(os.path.join(output_directory, "profiles_01.*")))
-        files_to_remove.extend(glob.glob(os.path.join(output_directory, "extracted_boundary.*")))
-       
-        for file_path in files_to_remove:
-            os.remove(file_path)
-           
         elapsed_time_profiles = time.time() - start_time_profiles  # Measure elapsed time for step 1
         feedback.pushInfo(f"Time elapsed for creating profiles: {format_time(elapsed_time_profiles)}")
         ####################################################Graph#################################################                                  
+        start_stage('graphs')
         start_time_graphs= time.time()
-        gdf = gpd.read_file(os.path.join(output_directory, 'profile.shp'))
-
-        for id_line, group in gdf.groupby(field_name):
-            x_data = []
-            y_data = []
-
-            for idx, row in group.iterrows():
-                # Check for the desired field name and assign the value to x_value
-                if 'DIST' in row:
-                    x_value = row['DIST']
-                elif 'DISTANCE' in row:
-                    x_value = row['DISTANCE']
-                else:
-                    feedback.pushInfo(f"{output_profile_final} was not correctly generated")
-                y_value = row['Z']
-
-
-                x_data.append(x_value)
-                y_data.append(y_value)
 
-            plt.figure(figsize=(20, 6))
-            min_y = min(y_data)
-            max_y = max(y_data)
-            y_Spacing = max_y - min_y
-            step_size = y_Spacing / 10  # intervals for axis Y
+        simplified_profiles = None
 
-            yticks = [round(min_y + i * step_size, 2) for i in range(int(y_Spacing / step_size) + 1)]
-            plt.yticks(yticks)
-            min_x = min(x_data)
-            max_x = max(x_data)
-            x_Spacing = max_x - min_x
-            step_size_x = x_Spacing / 10  # intervals for axis X
+        def load_simplified_profiles():
+            #collinear samples are thinned for graphs and export, banks and thalweg are kept
+            nonlocal simplified_profiles
+            if simplified_profiles is None:
+                simplified_profiles = load_profiles().simplify(simplify_tolerance)
+                if simplify_tolerance > 0:
+                    feedback.pushInfo(f"Profiles simplified from {len(profiles.z):,} to {len(simplified_profiles.z):,} samples")
+            return simplified_profiles
 
-            xticks = [round(min_x + i * step_size_x, 2) for i in range(int(x_Spacing / step_size_x) + 1)]
-            xticks_labels = [f'{x / 10:.2f}' for x in xticks]  # dist/100
+        def create_graphs():
+            #graphs are rendered in worker processes, each with its own figure
+            graphs = []
+            graph_profiles = load_simplified_profiles()
+            if selected_reaches:
+                #graphs of the other reaches are kept from the previous run
+                graph_profiles = graph_profiles.subset(np.array([str(reaches.get(profile_id)) in selected_reaches
+                                                                 for profile_id in graph_profiles.ids], dtype=bool))
+            total = len(graph_profiles)
+            try:
+                for id_line, output_path in render_profiles(graph_profiles, output_directory, workers):
+                    feedback.pushInfo(f"Saving profile {id_line} to {output_path}")
+                    graphs.append(output_path)
+                    #closing the generator on cancel stops graphs waiting in the pool
+                    stage_progress(len(graphs), total)
+            except BaseException:
+                #graphs are known only while they are written, graphs of a canceled stage are deleted here
+                if feedback.isCanceled():
+                    remove_outputs(graphs)
+                raise
+            return graphs
 
-            plt.grid(color='gray', linestyle='-', linewidth=0.1)
+        run_stage('graphs', profile_inputs, dict(profile_params, simplify=simplify_tolerance), None, create_graphs)
+        report.update('graphs', features=len(cache.outputs('graphs')))
 
-            output_path = os.path.join(output_directory, f'profile_{id_line}.png')
-            feedback.pushInfo(f"Saving profile {id_line} to {output_path}")
+        start_stage('cross_sections')
+        if export_formats:
+            def create_cross_sections():
+                feedback.pushInfo("Exporting cross sections for 1D hydraulic model...")
+                #centerline of every reach of the stream network runs over all its parts like TR_CHAINAGE
+                centerlines = {str(reach): parts for reach, (_, parts) in self.river_reaches(line_path, reach_field).items()}
+                return export_cross_sections(load_simplified_profiles(), output_directory, line_path.name(),
+                                             formats=export_formats, chainage=chainage, reaches=reaches,
+                                             centerlines=centerlines)
 
-            # style
-            plt.plot(x_data, y_data, linestyle='-', color='blue', linewidth=.5, label='graph')
-            plt.xlabel('distance [m]')
-            plt.ylabel('elevation [m]')
-            plt.title(f'Cross-section profile {id_line}')
-
-            plt.savefig(output_path)
-            plt.close()  # Close the figure after saving
+            run_stage('cross_sections', profile_inputs,
+                      dict(profile_params, formats=export_formats, simplify=simplify_tolerance),
+                      [os.path.join(output_directory, f'cross_sections.{extension}') for extension in export_formats],
+                      create_cross_sections)
             
         elapsed_time_graphs = time.time() - start_time_graphs  # Measure elapsed time creating graphs
         feedback.pushInfo(f"Time elapsed for creating graphs: {format_time(elapsed_time_graphs)}")
         
+        #deleting temporary (unnecessary) files after the last stage reading them, they are kept for reuse when cache is enabled
+        files_to_remove = []
+        files_to_remove.extend(glob.glob(os.path.join(output_directory, "profiles_01.*")))
+        if not use_cache:
+            del transects
+            files_to_remove.extend(glob.glob(os.path.join(output_directory, "extracted_boundary.*")))
+            files_to_remove.extend(glob.glob(os.path.join(output_directory, "transects.gpkg")))
+            if streaming or corridor_mode:
+                files_to_remove.extend(glob.glob(os.path.join(output_directory, "tiles.vpc")))
+            if corridor_mode:
+                files_to_remove.extend(f for f in glob.glob(os.path.join(output_directory, "corridor.*"))
+                                       if not f.endswith('.las') or not keep_intermediate)
+       
+        with report.stage('cleanup', files=len(files_to_remove)):
+            for file_path in files_to_remove:
+                os.remove(file_path)
+        
         ############################# preview ############################################################
+        start_stage('preview')
+        if add_to_project:
+            with report.stage('preview'):
+                self.create_preview(profile_layer, None if direct_sampling else output_DTM, field_name,
+                                    output_directory, feedback)
+
+        return {}
+
+    def create_preview(self, profile_layer, output_DTM, field_name, output_directory, feedback):
+        """
+        Adds DTM and profile layers to the current project and exports preview.png from a print layout.
+        Without DTM (point cloud profile engine), the preview shows extent of the profiles.
+        """
         # Vytvorenie vrstvy z výstupu result6
-        DTM_layer = QgsRasterLayer(output_DTM, 'DTM')
-        # Pridanie vrstiev do projektu)
-        QgsProject.instance().addMapLayer(DTM_layer)
+        if output_DTM is None:
+            preview_extent = profile_layer.extent()
+        else:
+            DTM_layer = QgsRasterLayer(output_DTM, 'DTM')
+            # Pridanie vrstiev do projektu)
+            QgsProject.instance().addMapLayer(DTM_layer)
+            preview_extent = DTM_layer.extent()
         QgsProject.instance().addMapLayer(profile_layer)
 
 
@@ -351,13 +1096,13 @@ class CrossProfilesAlgorithm(QgsProcessingAlgorithm):
         map.setRect(20, 20, 20, 20)
 
         # Set map extent
-        rect = QgsRectangle(DTM_layer.extent())
+        rect = QgsRectangle(preview_extent)
         map.setExtent(rect)
 
         # Resize and zoom the map item
         map.attemptMove(QgsLayoutPoint(5, 20, QgsUnitTypes.LayoutMillimeters))
         map.attemptResize(QgsLayoutSize(285, 185, QgsUnitTypes.LayoutMillimeters))
-        map.zoomToExtent(DTM_layer.extent())
+        map.zoomToExtent(preview_extent)
 
         # Add the map item to the layout
         layout.addLayoutItem(map)
@@ -408,7 +1153,132 @@ class CrossProfilesAlgorithm(QgsProcessingAlgorithm):
         preview = os.path.join(output_directory, 'preview.png')
         exporter.exportToImage(preview, QgsLayoutExporter.ImageExportSettings())
 
-        return {}
+    def saga_profiles_by_transect(self, transects, profiles):
+        """
+        Profiles of SAGA Profiles from Lines renumbered to TR_ID of their transects. SAGA numbers profiles
+        by the order of transects, from 0 or 1 depending on the version, the first profile decides which.
+        """
+        transect_ids = [feature['TR_ID'] for feature in transects.getFeatures()]
+        shift = 0
+        if len(profiles) and profiles.x is not None:
+            first = int(profiles.ids[0])
+            sample = QgsPointXY(profiles.x[0], profiles.y[0])
+            distances = {index: sample.distance(QgsPointXY(feature.geometry().vertexAt(0)))
+                         for index, feature in enumerate(transects.getFeatures()) if index in (first, first - 1)}
+            if first - 1 in distances and distances[first - 1] < distances.get(first, float('inf')):
+                shift = 1
+        indices = np.array([int(profile_id) - shift for profile_id in profiles.ids], dtype=np.int64)
+        known = (indices >= 0) & (indices < len(transect_ids))
+        profiles = profiles.subset(known)
+        #TR_ID grows with the order of transects, profiles stay sorted by ID
+        profiles.ids = np.array([transect_ids[index] for index in indices[known]], dtype=np.int64)
+        return profiles
+
+    def create_profile_layer(self, transects, profiles):
+        """Memory layer of transects which have a profile, with field ID of the profile (TR_ID of the transect)."""
+        profile_ids = {int(profile_id) for profile_id in profiles.ids}
+        profile_layer = QgsVectorLayer("LineString", "Profile_layer", "memory")
+        profile_layer.setCrs(transects.crs())
+        fields = QgsFields(transects.fields())
+        fields.append(QgsField('ID', QVariant.Int))
+        profile_layer.dataProvider().addAttributes(fields.toList())
+        profile_layer.updateFields()
+        features = []
+        for transect in transects.getFeatures():
+            profile_id = transect['TR_ID']
+            if profile_id not in profile_ids:
+                continue
+            feature = QgsFeature(fields)
+            feature.setGeometry(transect.geometry())
+            feature.setAttributes(transect.attributes() + [profile_id])
+            features.append(feature)
+        profile_layer.dataProvider().addFeatures(features)
+        profile_layer.updateExtents()
+        return profile_layer
+
+    def river_reaches(self, line, reach_field=None):
+        """
+        Features of the river line grouped into reaches by reach_field, every feature is a reach without it.
+        Returns {reach: (first feature, parts)}, parts of a reach which continue each other are joined.
+        """
+        reaches = {}
+        for feature in line.getFeatures():
+            reach = feature[reach_field] if reach_field else feature.id()
+            geometry = feature.geometry()
+            polylines = geometry.asMultiPolyline() if geometry.isMultipart() else [geometry.asPolyline()]
+            _, parts = reaches.setdefault(reach, (feature, []))
+            parts.extend(np.array([[point.x(), point.y()] for point in polyline]) for polyline in polylines
+                         if len(polyline) >= 2)
+        return {reach: (feature, join_line_parts(parts)) for reach, (feature, parts) in reaches.items() if parts}
+
+    def create_transects(self, line, Width, Spacing, boundary=None, output='TEMPORARY_OUTPUT', context=None, feedback=None,
+                         reach_field=None):
+        """
+        Creates transects (lines of profiles) perpendicular to the river line every Spacing metres.
+        Every reach of the river network (see river_reaches) gets its own transects, numbered from its start,
+        so tributaries are not dissolved with the main river. TR_CHAINAGE is the distance along the reach,
+        TR_REACH the reach, TR_ID is unique over the network. With the point cloud boundary, only transects
+        with their centre inside it are kept. Other fields are the same as of native:transect.
+        """
+        boundary_engine = None
+        if boundary is not None:
+            boundary_layer = QgsVectorLayer(boundary, 'boundary', 'ogr')
+            boundary_geometry = QgsGeometry.unaryUnion([f.geometry() for f in boundary_layer.getFeatures()])
+            boundary_engine = QgsGeometry.createGeometryEngine(boundary_geometry.constGet())
+            boundary_engine.prepareGeometry()
+
+        transects = QgsVectorLayer("LineString", "transects", "memory")
+        transects.setCrs(line.crs())
+        fields = QgsFields(line.fields())
+        for name, field_type in (('TR_FID', QVariant.Int), ('TR_ID', QVariant.Int), ('TR_SEGMENT', QVariant.Int),
+                                 ('TR_ANGLE', QVariant.Double), ('TR_LENGTH', QVariant.Double),
+                                 ('TR_ORIENT', QVariant.Int), ('TR_REACH', QVariant.String),
+                                 ('TR_CHAINAGE', QVariant.Double)):
+            fields.append(QgsField(name, field_type))
+        transects.dataProvider().addAttributes(fields.toList())
+        transects.updateFields()
+
+        #Creating transect (lines of profiles), TR_ID keeps numbering of transects on 1 m densified line,
+        #transects outside the boundary are counted too, so TR_ID is the same as profile ID without QGIS
+        features = []
+        index = 0
+        for reach, (line_feature, parts) in self.river_reaches(line, reach_field).items():
+            if feedback is not None and feedback.isCanceled():
+                raise QgsProcessingException(self.tr("Processing was canceled."))
+            #chainage goes on over the parts of a reach
+            start = 0.0
+            for vertices in parts:
+                stations, x, y, ux, uy, segment = transect_stations(vertices, Spacing)
+                for i in range(len(x)):
+                    profile_id = transect_id(index, Spacing)
+                    index += 1
+                    if boundary_engine is not None and not boundary_engine.intersects(QgsPoint(x[i], y[i])):
+                        continue
+                    feature = QgsFeature(fields)
+                    feature.setGeometry(QgsGeometry.fromPolylineXY([
+                        QgsPointXY(x[i] - uy[i] * Width, y[i] + ux[i] * Width),
+                        QgsPointXY(x[i] + uy[i] * Width, y[i] - ux[i] * Width)]))
+                    feature.setAttributes(line_feature.attributes() + [
+                        line_feature.id(), profile_id, int(segment[i]), 90.0, float(Width), 2,
+                        str(reach), start + float(stations[i])])
+                    features.append(feature)
+                start += float(np.hypot(*np.diff(vertices, axis=0).T).sum())
+        transects.dataProvider().addFeatures(features)
+        transects.updateExtents()
+
+        if output == 'TEMPORARY_OUTPUT':
+            return transects
+        processing.run("native:savefeatures", {'INPUT': transects, 'OUTPUT': output}, context=context, feedback=feedback)
+        return output
+
+    def line_fingerprint(self, layer, reach_field=None):
+        """Hash of the line layer geometries, reach IDs and CRS, used in cache keys instead of file times."""
+        digest = hashlib.sha256(layer.crs().authid().encode('utf-8'))
+        for feature in layer.getFeatures():
+            digest.update(bytes(feature.geometry().asWkb()))
+            if reach_field:
+                digest.update(str(feature[reach_field]).encode('utf-8'))
+        return digest.hexdigest()
 
     def name(self):
         return 'cross_profiles'
@@ -441,7 +1311,8 @@ class CrossProfilesAlgorithm(QgsProcessingAlgorithm):
         Be aware that profiles around the edge of the area may be shorter than the specified length.\n\
         The processing time may variably depend on the performance of the computer and the amount of data used.\
         Processing larger amounts of data may take longer and require more disk space.\
-        It is recommended to have sufficient free disk space and expect longer processing times with large data files.\n")
+        It is recommended to have sufficient free disk space and expect longer processing times with large data files.\n\
+        Streaming mode reads the LAS tiles in place through a PDAL virtual point cloud and does not write merged.las and filter.las.\n")
 
 
     def createInstance(self):